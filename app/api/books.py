@@ -8,6 +8,7 @@ from app.models.crud_model import (
     BookCreateRequest, BookUpdateRequest, BookResponse, DeleteResponse
 )
 from app.services.indexer import _compute_book_id
+from app.services.entity_cache import clear_entity_cache
 from app.core.auth import get_current_user, UserInfo
 from app.core.logger import get_logger
 
@@ -122,6 +123,7 @@ def update_book(
     
     if not updated:
         raise HTTPException(status_code=400, detail="No fields to update or update failed")
+    clear_entity_cache()
     
     # Get updated book
     book = book_repo.get_book_by_id(book_id)
@@ -153,6 +155,7 @@ def delete_book(book_id: str = Path(..., description="Book ID"), user: UserInfo
     
     if not deleted:
         raise HTTPException(status_code=500, detail="Failed to delete book")
+    clear_entity_cache()
     
     # Rebuild FAISS index sau khi xóa sách để đồng bộ
     from app.services.indexer import rebuild_faiss_index
@@ -7,6 +7,7 @@ from app.models.crud_model import (
     ChapterCreateRequest, ChapterUpdateRequest, ChapterResponse, DeleteResponse
 )
 from app.services.indexer import _compute_chapter_id
+from app.services.entity_cache import clear_entity_cache
 from app.core.auth import get_current_user, UserInfo
 from app.core.logger import get_logger
 
@@ -99,6 +100,7 @@ def update_chapter(
     
     if not updated:
         raise HTTPException(status_code=400, detail="No fields to update or update failed")
+    clear_entity_cache()
     
     # Get updated chapter
     chapter = chapter_repo.get_chapter_by_id(chapter_id)
@@ -126,6 +128,7 @@ def delete_chapter(chapter_id: str = Path(..., description="Chapter ID"), user:
     
     if not deleted:
         raise HTTPException(status_code=500, detail="Failed to delete chapter")
+    clear_entity_cache()
     
     return DeleteResponse(
         success=True,
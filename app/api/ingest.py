@@ -6,6 +6,8 @@ from app.repositories.book_repository import BookRepository
 from app.repositories.chunk_repository import ChunkRepository
 from app.repositories.chapter_repository import ChapterRepository
 from app.repositories.lesson_repository import LessonRepository
+from app.services.llm_cache import llm_cache
+from app.services.entity_cache import clear_entity_cache
 from app.core.logger import get_logger
 from app.core.auth import get_current_user, UserInfo
 import os
@@ -41,6 +43,8 @@ def _delete_book_resources(book_id: str, book_name: Optional[str] = None):
         logger.warning(f"Book metadata for '{book_id}' was not found during deletion")
 
     # Xóa cache (nếu có)
+    llm_cache.invalidate_book(book_id)
+    clear_entity_cache()
     if os.path.exists(CACHE_DIR):
         for f in os.listdir(CACHE_DIR):
             try:
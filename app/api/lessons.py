@@ -7,6 +7,7 @@ from app.models.crud_model import (
     LessonCreateRequest, LessonUpdateRequest, LessonResponse, DeleteResponse
 )
 from app.services.indexer import _compute_lesson_id
+from app.services.entity_cache import clear_entity_cache
 from app.core.auth import get_current_user, UserInfo
 from app.core.logger import get_logger
 
@@ -112,6 +113,7 @@ def update_lesson(
     
     if not updated:
         raise HTTPException(status_code=400, detail="No fields to update or update failed")
+    clear_entity_cache()
     
     # Get updated lesson
     lesson = lesson_repo.get_lesson_by_id(lesson_id)
@@ -135,6 +137,7 @@ def delete_lesson(lesson_id: str = Path(..., description="Lesson ID"), user: Use
     
     if not deleted:
         raise HTTPException(status_code=500, detail="Failed to delete lesson")
+    clear_entity_cache()
     
     return DeleteResponse(
         success=True,
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from app.models.rag_model import (
     RAGRequest, RAGResponse,
     SlideContentRequest, SlideContentResponse,
@@ -6,7 +7,9 @@ from app.models.rag_model import (
     TemplateSlidesRequest, TemplateSlidesResponse,
     ContentReviseRequest, ContentReviseResponse
 )
-from app.services.rag_engine import rag_query
+from app.services.rag_engine import rag_query, rag_query_stream
+from app.services.entity_cache import cached_get_book, cached_get_chapter, cached_get_lesson
+from app.services.utils import run_parallel
 from app.repositories.book_repository import BookRepository
 from app.repositories.chapter_repository import ChapterRepository
 from app.repositories.lesson_repository import LessonRepository
@@ -14,43 +17,78 @@ from app.core.config import SLIDES_BASE_URL, OPENAI_API_KEY, SLIDESGPT_API_KEY
 from app.core.auth import get_current_user, UserInfo
 from app.core.logger import get_logger
 from openai import OpenAI
-import requests, uuid, os
+import requests, uuid, os, json
 from app.repositories.content_repository import ContentRepository
 import re
 
 router = APIRouter()
 logger = get_logger(__name__)
 
-@router.post("/query", response_model=RAGResponse)
-def rag_query_endpoint(req: RAGRequest, user: UserInfo = Depends(get_current_user)):
-    """
-    RAG Query với 5 params: grade_id, book_id, chapter_id, lesson_id, content
-    """
-    logger.info(f"User {user.user_id} requested RAG query for lesson {req.lesson_id}")
-    # Get grade_number from grade_id
+def _resolve_rag_request(req: RAGRequest):
+    """Validate grade/book/subject của RAG request, trả về (grade, book, chapter, lesson)"""
     from app.repositories.grade_repository import GradeRepository
-    grade_repo = GradeRepository()
-    grade = grade_repo.get_grade_by_id(req.grade_id)
+    # Grade (lấy grade_number) + book/chapter/lesson (lấy tên) độc lập nhau -> lookup đồng thời
+    grade, book, chapter, lesson = run_parallel(
+        lambda: GradeRepository().get_grade_by_id(req.grade_id),
+        lambda: cached_get_book(req.book_id),
+        lambda: cached_get_chapter(req.chapter_id),
+        lambda: cached_get_lesson(req.lesson_id),
+    )
     if not grade:
         raise HTTPException(status_code=404, detail=f"Grade '{req.grade_id}' not found")
-    grade_number = grade.get("grade_number")
-
-    # Fetch book/chapter/lesson for names
-    book_repo = BookRepository()
-    book = book_repo.get_book_by_id(req.book_id)
     if not book:
         raise HTTPException(status_code=404, detail=f"Book '{req.book_id}' not found")
 
-    chapter_repo = ChapterRepository()
-    chapter = chapter_repo.get_chapter_by_id(req.chapter_id)
-    lesson_repo = LessonRepository()
-    lesson = lesson_repo.get_lesson_by_id(req.lesson_id)
-
     # Validate subject if provided: book.subject_id must match req.subject_id
     if req.subject_id:
         book_subject_id = book.get("subject_id")
         if book_subject_id != req.subject_id:
             raise HTTPException(status_code=400, detail="subject_id does not match the book's subject")
+    return grade, book, chapter, lesson
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@router.post("/query/stream")
+def rag_query_stream_endpoint(req: RAGRequest, user: UserInfo = Depends(get_current_user)):
+    """
+    RAG Query dạng Server-Sent Events: event "delta" là từng đoạn JSON outline LLM đang sinh,
+    event "result" cuối cùng giống /query (outline, sources, indices, distances).
+    Chỉ trả outline - không sinh/lưu content_text như /query.
+    """
+    logger.info(f"User {user.user_id} requested streaming RAG query for lesson {req.lesson_id}")
+    grade, _, _, _ = _resolve_rag_request(req)
+
+    def events():
+        for event, payload in rag_query_stream(
+            grade=grade.get("grade_number"),
+            book_id=req.book_id,
+            chapter_id=req.chapter_id,
+            lesson_id=req.lesson_id,
+            content=req.content,
+            k=req.k
+        ):
+            if event == "delta":
+                yield _sse("delta", {"text": payload})
+            else:
+                outline, distances, indices = payload
+                yield _sse("result", {
+                    "outline": outline,
+                    "sources": outline.get("sources", []),
+                    "indices": indices,
+                    "distances": distances,
+                })
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@router.post("/query", response_model=RAGResponse)
+def rag_query_endpoint(req: RAGRequest, user: UserInfo = Depends(get_current_user)):
+    """
+    RAG Query với 5 params: grade_id, book_id, chapter_id, lesson_id, content
+    """
+    logger.info(f"User {user.user_id} requested RAG query for lesson {req.lesson_id}")
+    grade, book, chapter, lesson = _resolve_rag_request(req)
+    grade_number = grade.get("grade_number")
     
     outline, distances, indices = rag_query(
         grade=grade_number,
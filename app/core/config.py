@@ -10,10 +10,27 @@ load_dotenv(dotenv_path=ENV_PATH)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 EMBED_MODEL = os.getenv("EMBED_MODEL", "text-embedding-ada-002")
 CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4-turbo")
+# Ngưỡng cosine similarity (inner product trên vector đã normalize) của chunk tốt nhất để gọi LLM
+RAG_RELEVANCE_THRESHOLD = float(os.getenv("RAG_RELEVANCE_THRESHOLD", "0.75"))
+
+# Query embedding cache: LRU trong process + Redis (tuỳ chọn, để trống REDIS_URL để tắt)
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "4096"))
+EMBED_CACHE_TTL = int(os.getenv("EMBED_CACHE_TTL", "604800"))  # 7 ngày
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Số request embedding chạy đồng thời khi ingest/rebuild
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))
+# Cache book/chapter/lesson theo id cho RAG query (LRU + TTL giây)
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "1024"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "300"))
 
 DATA_DIR = os.getenv("DATA_DIR", "app/data/faiss")
 CACHE_DIR = os.getenv("CACHE_DIR", "app/data/cache")
 FORCE_OCR = os.getenv("FORCE_OCR", "0") == "1"
+# Số process parse PDF song song theo trang (0 = dùng tất cả CPU cores, 1 = tuần tự)
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "0"))
+# OCR: render trang ở OCR_DPI (grayscale), Tesseract LSTM (--oem 1) với page segmentation mode OCR_PSM
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_PSM = int(os.getenv("OCR_PSM", "6"))
 
 # MongoDB Configuration
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
@@ -21,8 +38,42 @@ MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "ai_chatbot_mss301")
 
 # Paths (still used for FAISS index files)
 INDEX_PATH = os.path.join(DATA_DIR, "index.faiss")
+# Query embedding cache trên đĩa (sqlite) khi không dùng Redis; "" = tắt
+EMBED_CACHE_DB_PATH = os.getenv("EMBED_CACHE_DB_PATH", os.path.join(DATA_DIR, "embed_cache.sqlite"))
+# LLM semantic cache (kết quả rag_query theo bài học + query gần giống) - để trong DATA_DIR vì CACHE_DIR bị xoá khi xoá sách
+LLM_CACHE_INDEX_PATH = os.path.join(DATA_DIR, "llm_cache.faiss")
+LLM_CACHE_DATA_PATH = os.path.join(DATA_DIR, "llm_cache.json")
+LLM_CACHE_THRESHOLD = float(os.getenv("LLM_CACHE_THRESHOLD", "0.95"))
+# Số query tối đa mỗi bucket (book_id, chapter_id, lesson_id, k, ...), LRU
+LLM_CACHE_BUCKET_SIZE = int(os.getenv("LLM_CACHE_BUCKET_SIZE", "1000"))
+# Ghi chú giáo viên ngắn hơn N ký tự: query embedding bị tên chương/bài chi phối, 2 ghi chú khác nhau
+# vẫn có thể đạt cosine >= threshold -> chỉ dùng lại kết quả khi ghi chú trùng khớp (sau chuẩn hoá)
+LLM_CACHE_EXACT_MATCH_CHARS = int(os.getenv("LLM_CACHE_EXACT_MATCH_CHARS", "200"))
+# FAISS OpenMP threads (0 = use all CPU cores)
+FAISS_NUM_THREADS = int(os.getenv("FAISS_NUM_THREADS", "0"))
+# FAISS index type: "hnsw" (graph, search ~log N) | "ivfpq" (inverted file + PQ, ít bộ nhớ nhất)
+#                   | "flat" (exact, quét toàn bộ)
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "hnsw").lower()
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_HNSW_EF_CONSTRUCTION = int(os.getenv("FAISS_HNSW_EF_CONSTRUCTION", "200"))
+FAISS_HNSW_EF_SEARCH = int(os.getenv("FAISS_HNSW_EF_SEARCH", "64"))
+# Lượng tử hoá vector trong index: "8bit" (1/4 bộ nhớ float32, cần train) | "fp16" (1/2)
+FAISS_SQ_TYPE = os.getenv("FAISS_SQ_TYPE", "8bit").lower()
+# IVF-PQ: số cluster (tối đa, co theo số vector / 39), số sub-quantizer PQ (tự hạ xuống ước của
+# dimension), số cluster quét mỗi query. Dưới 9984 vector dùng flat SQ thay cho IVF-PQ
+FAISS_IVF_NLIST = int(os.getenv("FAISS_IVF_NLIST", "256"))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "32"))
+FAISS_IVF_NPROBE = int(os.getenv("FAISS_IVF_NPROBE", "10"))
+# Micro-batching FAISS search: gom query đến trong cửa sổ N ms thành 1 lần search (0 = tắt).
+# Query đến một mình vẫn chờ hết cửa sổ -> mỗi query lẻ chậm thêm tối đa N ms; chỉ có lợi khi tải
+# đồng thời cao, traffic thưa thì đặt 0 để search trực tiếp
+FAISS_BATCH_WINDOW_MS = float(os.getenv("FAISS_BATCH_WINDOW_MS", "5"))
+FAISS_BATCH_MAX_SIZE = int(os.getenv("FAISS_BATCH_MAX_SIZE", "32"))
+# Search trên GPU (cần faiss-gpu + CUDA); không có GPU / index không hỗ trợ thì tự dùng CPU
+FAISS_USE_GPU = os.getenv("FAISS_USE_GPU", "1") == "1"
+FAISS_GPU_DEVICE = int(os.getenv("FAISS_GPU_DEVICE", "0"))
 # META_PATH deprecated - using MongoDB instead
-# META_PATH = os.path.join(DATA_DIR, "metadata.json")  # Only for migration script
+META_PATH = os.path.join(DATA_DIR, "metadata.json")  # Only for migration script
 
 # Slides generation (external) - used to build embed/download links in RAG response
 SLIDES_BASE_URL = os.getenv("SLIDES_BASE_URL", "https://api.slidesgpt.com")
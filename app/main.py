@@ -10,13 +10,17 @@ from .repositories.chunk_repository import ChunkRepository
 from .repositories.chapter_repository import ChapterRepository
 from .repositories.lesson_repository import LessonRepository
 from .repositories.grade_repository import GradeRepository
-from .services.utils import ensure_data_dirs
+from .services.utils import ensure_data_dirs, configure_faiss
+from .services.llm_cache import llm_cache
+from .services.indexer import migrate_faiss_index
+from .services.rag_engine import warm_up_index
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     logger = get_logger(__name__)
     ensure_data_dirs()
+    configure_faiss()
     try:
         # Initialize MongoDB connection and create indexes
         get_database()
@@ -27,14 +31,23 @@ async def lifespan(app: FastAPI):
         grade_repo = GradeRepository()
         book_repo.create_indexes()
         chunk_repo.create_indexes()
+        chunk_repo.backfill_metadata_scores()
         chapter_repo.create_indexes()
         lesson_repo.create_indexes()
         grade_repo.create_indexes()
         logger.info("MongoDB initialized and indexes created")
     except Exception as e:
         logger.error(f"Failed to initialize MongoDB: {e}")
+    try:
+        # Index cũ (L2 / khác FAISS_INDEX_TYPE) -> chuyển đổi 1 lần, không embed lại
+        migrate_faiss_index()
+    except Exception as e:
+        logger.error(f"Failed to migrate FAISS index: {e}")
+    # Load index (+ copy lên GPU nếu có) trước request đầu tiên
+    warm_up_index()
     yield
     # Shutdown
+    llm_cache.save()
     close_database()
     logger.info("Application shutdown")
 
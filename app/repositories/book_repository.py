@@ -60,6 +60,12 @@ class BookRepository:
         """Get book by book_id"""
         return self.collection.find_one({"book_id": book_id})
     
+    def get_books_by_ids(self, book_ids: List[str]) -> List[Dict]:
+        """Get many books in one query"""
+        if not book_ids:
+            return []
+        return list(self.collection.find({"book_id": {"$in": list(book_ids)}}, {"_id": 0}))
+    
     def get_book_by_name(self, book_name: str) -> Optional[Dict]:
         """Get book by book_name"""
         return self.collection.find_one({"book_name": book_name})
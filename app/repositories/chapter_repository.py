@@ -52,6 +52,12 @@ class ChapterRepository:
         """Get chapter by chapter_id"""
         return self.collection.find_one({"chapter_id": chapter_id})
     
+    def get_chapters_by_ids(self, chapter_ids: List[str]) -> List[Dict]:
+        """Get many chapters in one query"""
+        if not chapter_ids:
+            return []
+        return list(self.collection.find({"chapter_id": {"$in": list(chapter_ids)}}, {"_id": 0}))
+    
     def get_chapters_by_book(self, book_id: str) -> List[Dict]:
         """Get all chapters for a book, ordered by order field"""
         return list(self.collection.find(
@@ -1,9 +1,16 @@
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 from app.core.database import get_database
 from app.core.logger import get_logger
 
 logger = get_logger(__name__)
 
+# Mặc định của filter chapter_id / lesson_id: không lọc. None là giá trị thật (chunk không có chapter/lesson)
+_ANY = object()
+
+def metadata_score(chunk: Dict) -> int:
+    """Độ ưu tiên tĩnh khi đưa chunk vào prompt: có chapter_id +10, có lesson_id +5"""
+    return (10 if chunk.get("chapter_id") else 0) + (5 if chunk.get("lesson_id") else 0)
+
 class ChunkRepository:
     """Repository for document chunks and embeddings"""
     
@@ -25,6 +32,8 @@ class ChunkRepository:
         self.collection.create_index([("book_id", 1), ("page", 1)])
         self.collection.create_index([("book_id", 1), ("chapter_id", 1)])
         self.collection.create_index([("book_id", 1), ("chapter_id", 1), ("lesson_id", 1)])
+        # Cho get_chunks_by_indices_filtered: lọc book/chapter/lesson + $in embedding_index trên cùng index
+        self.collection.create_index([("book_id", 1), ("chapter_id", 1), ("lesson_id", 1), ("embedding_index", 1)])
     
     def insert_chunks(self, chunks: List[Dict], book_id: str):
         """
@@ -34,9 +43,10 @@ class ChunkRepository:
         if not chunks:
             return
         
-        # Add book_id to each chunk
+        # Add book_id + metadata_score to each chunk
         for chunk in chunks:
             chunk["book_id"] = book_id
+            chunk["metadata_score"] = metadata_score(chunk)
         
         self.collection.insert_many(chunks)
         logger.info(f"Inserted {len(chunks)} chunks for book: {book_id}")
@@ -67,6 +77,48 @@ class ChunkRepository:
         
         return result
     
+    def get_chunks_by_indices_filtered(
+        self,
+        indices: List[int],
+        book_id: str,
+        chapter_id: Any = _ANY,
+        lesson_id: Any = _ANY,
+    ) -> List[Dict]:
+        """
+        Get chunks by embedding indices that belong to book_id (and chapter_id / lesson_id if given),
+        filtered by MongoDB instead of in Python, preserving the order of indices.
+        chapter_id / lesson_id = None chỉ khớp chunk không có field đó (so sánh bằng, không phải wildcard)
+        """
+        if not indices:
+            return []
+        
+        query = {"embedding_index": {"$in": indices}, "book_id": book_id}
+        # {field: None} trong MongoDB khớp cả null lẫn thiếu field, giống chunk.get(field) == None
+        if chapter_id is not _ANY:
+            query["chapter_id"] = chapter_id
+        if lesson_id is not _ANY:
+            query["lesson_id"] = lesson_id
+        
+        chunks_map = {
+            chunk["embedding_index"]: chunk
+            for chunk in self.collection.find(query, {"_id": 0})
+        }
+        return [chunks_map[idx] for idx in indices if idx in chunks_map]
+    
+    def backfill_metadata_scores(self) -> int:
+        """Set metadata_score on chunks ingested before the field existed (server-side, one update)"""
+        def points(field: str, value: int) -> Dict:
+            # Field thiếu / null / "" -> 0, giống metadata_score() phía Python
+            return {"$cond": [{"$ne": [{"$ifNull": [field, ""]}, ""]}, value, 0]}
+        
+        result = self.collection.update_many(
+            {"metadata_score": {"$exists": False}},
+            [{"$set": {"metadata_score": {"$add": [points("$chapter_id", 10), points("$lesson_id", 5)]}}}],
+        )
+        if result.modified_count:
+            logger.info(f"Backfilled metadata_score on {result.modified_count} chunks")
+        return result.modified_count
+    
     def delete_chunks_by_book(self, book_id: str) -> int:
         """Delete all chunks for a book"""
         result = self.collection.delete_many({"book_id": book_id})
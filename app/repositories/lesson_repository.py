@@ -56,6 +56,12 @@ class LessonRepository:
         """Get lesson by lesson_id"""
         return self.collection.find_one({"lesson_id": lesson_id})
     
+    def get_lessons_by_ids(self, lesson_ids: List[str]) -> List[Dict]:
+        """Get many lessons in one query"""
+        if not lesson_ids:
+            return []
+        return list(self.collection.find({"lesson_id": {"$in": list(lesson_ids)}}, {"_id": 0}))
+    
     def get_lessons_by_chapter(self, chapter_id: str) -> List[Dict]:
         """Get all lessons for a chapter, ordered by order field"""
         return list(self.collection.find(
@@ -2,10 +2,10 @@
 Script để migrate dữ liệu từ metadata.json sang MongoDB
 Chạy: python -m app.scripts.migrate_to_mongodb
 """
-import json
 import os
 import sys
 from pathlib import Path
+import orjson
 
 # Add project root to path
 project_root = Path(__file__).resolve().parents[2]
@@ -33,9 +33,9 @@ def migrate_metadata_to_mongodb():
     
     logger.info(f"Reading metadata from {META_PATH}")
     
-    # Read metadata.json
-    with open(META_PATH, "r", encoding="utf-8") as f:
-        metadata = json.load(f)
+    # Read metadata.json (orjson: parse bytes trực tiếp, nhanh hơn json.load nhiều lần với file lớn)
+    with open(META_PATH, "rb") as f:
+        metadata = orjson.loads(f.read())
     
     # Initialize repositories
     book_repo = BookRepository()
@@ -0,0 +1,17 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# Không import faiss/numpy ở đây: parser import module này, và mỗi process worker (spawn) parse PDF
+# import lại parser -> giữ nhẹ để worker không load faiss/OpenMP chỉ để parse trang
+
+def run_coroutine_sync(coro):
+    """
+    Chạy coroutine từ code sync (endpoint def chạy trong threadpool, script...).
+    Nếu thread hiện tại đang có event loop (vd. gọi từ lifespan) thì chạy loop riêng trên thread khác.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
@@ -0,0 +1,156 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import numpy as np
+from app.core.config import EMBED_MODEL, EMBED_CACHE_SIZE, EMBED_CACHE_TTL, EMBED_CACHE_DB_PATH, REDIS_URL
+from app.core.logger import get_logger
+from app.services.embedder import embed_query
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = get_logger(__name__)
+
+# Layer 1: LRU trong process (hit nóng, không tốn network)
+_lru: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_lru_lock = threading.Lock()
+
+# Layer 2: Redis dùng chung giữa các worker/lần restart (tuỳ chọn, bật khi có REDIS_URL)
+_redis_client = None
+if REDIS_URL:
+    if redis is None:
+        logger.warning("REDIS_URL is set but redis package is not installed - using in-process embed cache only")
+    else:
+        _redis_client = redis.Redis.from_url(REDIS_URL)
+
+# Layer 2 khi không có Redis: sqlite (BLOB float32) trên đĩa - sống qua restart, dùng chung giữa
+# các worker trên cùng máy. Để trống EMBED_CACHE_DB_PATH để tắt
+_sqlite_conn: Optional[sqlite3.Connection] = None
+_sqlite_lock = threading.Lock()
+_sqlite_disabled = _redis_client is not None or not EMBED_CACHE_DB_PATH
+
+def _cache_key(text: str) -> str:
+    # Model nằm trong key: đổi EMBED_MODEL sẽ không dùng nhầm vector cũ
+    return hashlib.blake2b(f"{EMBED_MODEL}\n{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+def _lru_get(key: str) -> Optional[np.ndarray]:
+    with _lru_lock:
+        vec = _lru.get(key)
+        if vec is not None:
+            _lru.move_to_end(key)
+        return vec
+
+def _lru_put(key: str, vec: np.ndarray) -> None:
+    with _lru_lock:
+        _lru[key] = vec
+        _lru.move_to_end(key)
+        while len(_lru) > EMBED_CACHE_SIZE:
+            _lru.popitem(last=False)
+
+def _redis_get(key: str) -> Optional[np.ndarray]:
+    if _redis_client is None:
+        return None
+    try:
+        raw = _redis_client.get(f"emb:{key}")
+    except Exception as e:
+        logger.warning(f"Redis GET failed, skipping embed cache layer: {e}")
+        return None
+    if raw is None:
+        return None
+    return np.frombuffer(raw, dtype="float32")
+
+def _redis_put(key: str, vec: np.ndarray) -> None:
+    if _redis_client is None:
+        return
+    try:
+        _redis_client.setex(f"emb:{key}", EMBED_CACHE_TTL, vec.tobytes())
+    except Exception as e:
+        logger.warning(f"Redis SETEX failed: {e}")
+
+def _sqlite() -> Optional[sqlite3.Connection]:
+    """Mở DB lần đầu cần dùng (gọi khi đang giữ _sqlite_lock); lỗi thì tắt layer này"""
+    global _sqlite_conn, _sqlite_disabled
+    if _sqlite_conn is None and not _sqlite_disabled:
+        try:
+            os.makedirs(os.path.dirname(EMBED_CACHE_DB_PATH) or ".", exist_ok=True)
+            conn = sqlite3.connect(EMBED_CACHE_DB_PATH, check_same_thread=False, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL, created_at REAL NOT NULL)")
+            conn.commit()
+            _sqlite_conn = conn
+        except sqlite3.Error as e:
+            logger.warning(f"Cannot open embed cache DB {EMBED_CACHE_DB_PATH}, using in-process cache only: {e}")
+            _sqlite_disabled = True
+    return _sqlite_conn
+
+def _sqlite_get(key: str) -> Optional[np.ndarray]:
+    if _sqlite_disabled:
+        return None
+    with _sqlite_lock:
+        conn = _sqlite()
+        if conn is None:
+            return None
+        try:
+            row = conn.execute("SELECT vec, created_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Embed cache DB read failed: {e}")
+            return None
+    if row is None or time.time() - row[1] > EMBED_CACHE_TTL:
+        return None
+    return np.frombuffer(row[0], dtype="float32")
+
+def _sqlite_put(key: str, vec: np.ndarray) -> None:
+    if _sqlite_disabled:
+        return
+    with _sqlite_lock:
+        conn = _sqlite()
+        if conn is None:
+            return
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vec, created_at) VALUES (?, ?, ?)",
+                (key, vec.tobytes(), time.time()),
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.warning(f"Embed cache DB write failed: {e}")
+
+def _normalized(vec: np.ndarray) -> np.ndarray:
+    """L2-normalize 1 lần lúc đưa vào LRU; khoá ghi vì cùng array được trả cho mọi request"""
+    vec = np.array(vec, dtype="float32")
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec /= norm
+    vec.flags.writeable = False
+    return vec
+
+def cached_embed_query(text: str) -> np.ndarray:
+    """
+    embed_query có cache 2 tầng: LRU trong process -> Redis hoặc sqlite trên đĩa (TTL) -> OpenAI.
+    Returns: vector float32 đã L2-normalize, read-only (dùng thẳng cho search inner product, không copy)
+    """
+    key = _cache_key(text)
+    
+    vec = _lru_get(key)
+    if vec is not None:
+        return vec
+    
+    vec = _redis_get(key)
+    if vec is None:
+        vec = _sqlite_get(key)
+    if vec is None:
+        vec = np.asarray(embed_query(text), dtype="float32")
+        _redis_put(key, vec)
+        _sqlite_put(key, vec)
+    else:
+        logger.info("Query embedding served from persistent cache")
+    
+    vec = _normalized(vec)
+    _lru_put(key, vec)
+    return vec
@@ -1,24 +1,42 @@
+import asyncio
 from typing import List
-from openai import OpenAI
-from app.core.config import OPENAI_API_KEY, EMBED_MODEL
+from openai import OpenAI, AsyncOpenAI
+from app.core.config import OPENAI_API_KEY, EMBED_MODEL, EMBED_CONCURRENCY
 from app.core.logger import get_logger
+from app.services.async_utils import run_coroutine_sync
 
 logger = get_logger(__name__)
 
+# Client sync dùng chung cho embed_query (giữ connection pool giữa các request)
+_openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+
 def _get_client() -> OpenAI:
-    if not OPENAI_API_KEY:
+    if _openai_client is None:
         raise ValueError("OPENAI_API_KEY is not set. Add it to app/.env")
-    return OpenAI(api_key=OPENAI_API_KEY)
+    return _openai_client
+
+async def _embed_texts_async(texts: List[str], batch_size: int) -> List[List[float]]:
+    # Gửi tối đa EMBED_CONCURRENCY batch cùng lúc; kết quả ghép lại đúng thứ tự batch
+    semaphore = asyncio.Semaphore(max(1, EMBED_CONCURRENCY))
+    done = 0
+    
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as client:
+        async def embed_batch(batch: List[str]) -> List[List[float]]:
+            nonlocal done
+            async with semaphore:
+                resp = await client.embeddings.create(model=EMBED_MODEL, input=batch)
+            done += len(batch)
+            logger.info(f"Embedded {done}/{len(texts)}")
+            return [d.embedding for d in resp.data]
+        
+        batches = [texts[i:i+batch_size] for i in range(0, len(texts), batch_size)]
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+    return [vec for batch_vectors in results for vec in batch_vectors]
 
 def embed_texts(texts: List[str], batch_size: int = 100) -> List[List[float]]:
-    client = _get_client()
-    vectors: List[List[float]] = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        resp = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        vectors.extend([d.embedding for d in resp.data])
-        logger.info(f"Embedded {i+len(batch)}/{len(texts)}")
-    return vectors
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY is not set. Add it to app/.env")
+    return run_coroutine_sync(_embed_texts_async(texts, batch_size))
 
 def embed_query(text: str) -> List[float]:
     client = _get_client()
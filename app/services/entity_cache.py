@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+from app.core.config import ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL
+from app.repositories.book_repository import BookRepository
+from app.repositories.chapter_repository import ChapterRepository
+from app.repositories.lesson_repository import LessonRepository
+
+class _TTLCache:
+    """LRU + TTL: book/chapter/lesson gần như không đổi nhưng bị đọc ở mọi RAG query"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: Dict) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+_books = _TTLCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+_chapters = _TTLCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+_lessons = _TTLCache(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL)
+
+def _get_one(cache: _TTLCache, key: Optional[str], fetch: Callable[[str], Optional[Dict]]) -> Optional[Dict]:
+    if not key:
+        return None
+    doc = cache.get(key)
+    if doc is None:
+        doc = fetch(key)
+        # Không cache "không tìm thấy": sách/bài vừa ingest phải thấy ngay
+        if doc is not None:
+            cache.put(key, doc)
+    return doc
+
+def _get_many(cache: _TTLCache, keys: Iterable[str], fetch_many: Callable[[List[str]], List[Dict]], id_field: str) -> Dict[str, Dict]:
+    found: Dict[str, Dict] = {}
+    missing = []
+    for key in set(keys):
+        if not key:
+            continue
+        doc = cache.get(key)
+        if doc is None:
+            missing.append(key)
+        else:
+            found[key] = doc
+    if missing:
+        for doc in fetch_many(missing):
+            cache.put(doc[id_field], doc)
+            found[doc[id_field]] = doc
+    return found
+
+# Repository chỉ tạo khi miss; document trả về dùng chung giữa các request -> caller chỉ đọc, không sửa
+
+def cached_get_book(book_id: str) -> Optional[Dict]:
+    return _get_one(_books, book_id, lambda k: BookRepository().get_book_by_id(k))
+
+def cached_get_chapter(chapter_id: str) -> Optional[Dict]:
+    return _get_one(_chapters, chapter_id, lambda k: ChapterRepository().get_chapter_by_id(k))
+
+def cached_get_lesson(lesson_id: str) -> Optional[Dict]:
+    return _get_one(_lessons, lesson_id, lambda k: LessonRepository().get_lesson_by_id(k))
+
+def cached_get_books(book_ids: Iterable[str]) -> Dict[str, Dict]:
+    return _get_many(_books, book_ids, lambda ks: BookRepository().get_books_by_ids(ks), "book_id")
+
+def cached_get_chapters(chapter_ids: Iterable[str]) -> Dict[str, Dict]:
+    return _get_many(_chapters, chapter_ids, lambda ks: ChapterRepository().get_chapters_by_ids(ks), "chapter_id")
+
+def cached_get_lessons(lesson_ids: Iterable[str]) -> Dict[str, Dict]:
+    return _get_many(_lessons, lesson_ids, lambda ks: LessonRepository().get_lessons_by_ids(ks), "lesson_id")
+
+def clear_entity_cache() -> None:
+    """Gọi sau khi ghi book/chapter/lesson (CRUD, ingest, xoá sách)"""
+    _books.clear()
+    _chapters.clear()
+    _lessons.clear()
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+import numpy as np, faiss
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+class _PendingSearch:
+    __slots__ = ("index", "qvec", "k", "future")
+
+    def __init__(self, index: faiss.Index, qvec: np.ndarray, k: int):
+        self.index = index
+        self.qvec = qvec
+        self.k = k
+        self.future: Future = Future()
+
+class FaissBatcher:
+    """
+    Micro-batcher cho FAISS search: các query đến trong cùng cửa sổ window_ms được gộp thành
+    1 ma trận (B, d) và search 1 lần (kernel batch tận dụng BLAS/SIMD + OpenMP tốt hơn nhiều
+    so với B lần search 1 vector). Kết quả trả về từng request qua Future.
+    
+    - Query trên index khác nhau (index vừa reload) được search riêng theo từng index
+    - Batch search với k lớn nhất trong batch, mỗi request lấy k cột đầu của mình
+    - params_fn(index, k) tạo SearchParameters (efSearch/nprobe) cho lần search gộp
+    """
+
+    def __init__(
+        self,
+        window_ms: float,
+        max_batch: int,
+        params_fn: Optional[Callable[[faiss.Index, int], Optional[faiss.SearchParameters]]] = None,
+    ):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.params_fn = params_fn
+        self._queue: "queue.Queue[_PendingSearch]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+
+    def search(self, index: faiss.Index, qvec: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Blocking: trả về (distances, indices) shape (1, k) giống index.search"""
+        if self.window <= 0:
+            return self._search(index, qvec, k)
+        pending = _PendingSearch(index, qvec, k)
+        self._ensure_worker()
+        self._queue.put(pending)
+        return pending.future.result()
+
+    def _search(self, index: faiss.Index, xq: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        params = self.params_fn(index, k) if self.params_fn else None
+        if params is not None:
+            return index.search(xq, k, params=params)
+        return index.search(xq, k)
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None:
+            return
+        with self._worker_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="faiss-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: List[_PendingSearch]) -> None:
+        groups: dict = {}
+        for pending in batch:
+            groups.setdefault(id(pending.index), []).append(pending)
+
+        for group in groups.values():
+            index = group[0].index
+            k = max(p.k for p in group)
+            try:
+                xq = np.ascontiguousarray(np.vstack([p.qvec for p in group]), dtype="float32")
+                distances, indices = self._search(index, xq, k)
+            except Exception as e:
+                for p in group:
+                    p.future.set_exception(e)
+                continue
+            if len(group) > 1:
+                logger.info(f"Batched FAISS search: {len(group)} queries in one call")
+            for row, p in enumerate(group):
+                p.future.set_result((distances[row:row + 1, :p.k], indices[row:row + 1, :p.k]))
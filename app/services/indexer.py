@@ -1,14 +1,20 @@
 import os, json, time, hashlib, requests
+from collections import Counter, defaultdict
 from typing import Dict, List, Optional
-import numpy as np, faiss
+import numpy as np, faiss, orjson
 from pymongo import UpdateOne
-from app.core.config import INDEX_PATH, DATA_DIR, CACHE_DIR
+from app.core.config import (
+    INDEX_PATH, DATA_DIR, CACHE_DIR,
+    FAISS_INDEX_TYPE, FAISS_HNSW_M, FAISS_HNSW_EF_CONSTRUCTION, FAISS_SQ_TYPE,
+    FAISS_IVF_NLIST, FAISS_PQ_M,
+)
 from app.core.logger import get_logger
-from app.services.parser import parse_pdf_bytes, extract_toc_candidates
+from app.services.parser import parse_pdf_bytes, extract_toc_candidates, detect_parse_mode
 from openai import OpenAI
 from app.core.config import OPENAI_API_KEY, CHAT_MODEL
 from app.services.chunker import chunk_pages
 from app.services.embedder import embed_texts
+from app.services.llm_cache import llm_cache
 from app.repositories.book_repository import BookRepository
 from app.repositories.chunk_repository import ChunkRepository
 from app.repositories.chapter_repository import ChapterRepository
@@ -16,14 +22,150 @@ from app.repositories.lesson_repository import LessonRepository
 
 logger = get_logger(__name__)
 
-def _ensure_index(dim: int) -> faiss.IndexFlatL2:
+# Reuse one client (and its HTTP connection pool) across ingests
+_openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
+
+_SQ_TYPES = {
+    "8bit": faiss.ScalarQuantizer.QT_8bit,
+    "fp16": faiss.ScalarQuantizer.QT_fp16,
+}
+_SQ_QTYPE = _SQ_TYPES.get(FAISS_SQ_TYPE, faiss.ScalarQuantizer.QT_8bit)
+
+# k-means của FAISS cần ~39 điểm mỗi centroid; PQ 8 bit có 256 centroid mỗi sub-quantizer.
+# Ít vector hơn thì IVF-PQ train kém (hoặc lỗi) -> dùng flat SQ (exact, vẫn nhỏ ở cỡ này)
+_IVFPQ_MIN_TRAIN = 39 * 256
+
+def _pq_m(dim: int) -> int:
+    """Số sub-quantizer PQ lớn nhất <= FAISS_PQ_M chia hết dimension"""
+    return next(m for m in range(max(1, min(FAISS_PQ_M, dim)), 0, -1) if dim % m == 0)
+
+def _new_index(dim: int, n_train: int = 0) -> faiss.Index:
+    """
+    Tạo FAISS index rỗng: vector lượng tử hoá theo FAISS_SQ_TYPE
+    (8bit = 1/4 bộ nhớ float32, cần train min/max từng chiều; fp16 = 1/2, không cần train).
+    Metric inner product trên vector đã chuẩn hoá L2 -> score chính là cosine similarity.
+    FAISS_INDEX_TYPE=hnsw: đồ thị HNSW trên storage đã lượng tử hoá (search ~log N, efSearch set lúc query).
+    FAISS_INDEX_TYPE=ivfpq: IVF{nlist},PQ{m} - vector nén còn m byte, chỉ quét nprobe cluster mỗi query;
+    nlist co theo n_train (số vector sẽ train), dưới _IVFPQ_MIN_TRAIN vector thì dùng flat SQ.
+    Index chưa train sẽ được train trên batch vector đầu tiên được add.
+    """
+    if FAISS_INDEX_TYPE == "ivfpq":
+        if n_train >= _IVFPQ_MIN_TRAIN:
+            nlist = max(1, min(FAISS_IVF_NLIST, n_train // 39))
+            return faiss.index_factory(dim, f"IVF{nlist},PQ{_pq_m(dim)}", faiss.METRIC_INNER_PRODUCT)
+        logger.info(f"Only {n_train} vectors - using flat SQ index until there are {_IVFPQ_MIN_TRAIN} for IVF-PQ")
+    if FAISS_INDEX_TYPE == "hnsw":
+        index = faiss.IndexHNSWSQ(dim, _SQ_QTYPE, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+        return index
+    return faiss.IndexScalarQuantizer(dim, _SQ_QTYPE, faiss.METRIC_INNER_PRODUCT)
+
+def _sq_qtype(index: faiss.Index) -> Optional[int]:
+    storage = faiss.downcast_index(index.storage) if isinstance(index, faiss.IndexHNSW) else index
+    sq = getattr(storage, "sq", None)
+    return sq.qtype if sq is not None else None
+
+def _index_matches_config(index: faiss.Index) -> bool:
+    if index.metric_type != faiss.METRIC_INNER_PRODUCT:
+        return False
+    if FAISS_INDEX_TYPE == "ivfpq":
+        if isinstance(index, faiss.IndexIVFPQ):
+            return True
+        # Corpus còn nhỏ: flat SQ là index đúng cho cấu hình ivfpq (xem _new_index)
+        if index.ntotal >= _IVFPQ_MIN_TRAIN or isinstance(index, faiss.IndexHNSW):
+            return False
+    elif isinstance(index, faiss.IndexHNSW) != (FAISS_INDEX_TYPE == "hnsw"):
+        return False
+    return _sq_qtype(index) == _SQ_QTYPE
+
+def _write_index(index: faiss.Index):
+    """
+    Ghi index ra file tạm rồi os.replace() (atomic): process đang mmap file cũ
+    vẫn đọc inode cũ, không bao giờ thấy file ghi dở.
+    """
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp_path = f"{INDEX_PATH}.tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, INDEX_PATH)
+
+def _ensure_index(dim: int) -> faiss.Index:
     if os.path.exists(INDEX_PATH):
         return faiss.read_index(INDEX_PATH)
-    os.makedirs(DATA_DIR, exist_ok=True)
-    index = faiss.IndexFlatL2(dim)
-    faiss.write_index(index, INDEX_PATH)
+    index = _new_index(dim)
+    _write_index(index)
     return index
 
+def _migrate_index(index: faiss.Index) -> faiss.Index:
+    """
+    Chuyển index cũ (IndexFlatL2 chưa chuẩn hoá, hoặc khác FAISS_INDEX_TYPE) sang loại index hiện tại
+    mà KHÔNG embed lại: lấy lại vector bằng reconstruct_n -> normalize_L2 -> add vào index mới -> ghi đè file.
+    """
+    logger.info(f"Migrating FAISS index ({index.ntotal} vectors, {type(index).__name__}) to {FAISS_INDEX_TYPE}/inner product")
+    new_index = _new_index(index.d, index.ntotal)
+    if isinstance(index, faiss.IndexIVF):
+        # IVF cần direct map (id -> vị trí trong inverted list) mới reconstruct được
+        index.make_direct_map()
+    if index.ntotal:
+        xb = np.ascontiguousarray(index.reconstruct_n(0, index.ntotal), dtype="float32")
+        faiss.normalize_L2(xb)
+        if not new_index.is_trained:
+            new_index.train(xb)
+        new_index.add(xb)
+    _write_index(new_index)
+    return new_index
+
+def _compact_index(index: faiss.Index, chunk_repo: ChunkRepository) -> faiss.Index:
+    """
+    Bỏ vector của các chunk đã xoá khỏi MongoDB (ingest lại sách) mà KHÔNG embed lại: reconstruct vector
+    của chunk còn lại theo thứ tự embedding_index, add vào bản sao rỗng của index (giữ nguyên tham số đã
+    train), đánh lại embedding_index liên tục 0..n-1 rồi ghi đè file.
+    MongoDB lệch với index (hoặc index không reconstruct được) -> RuntimeError, caller rebuild.
+    """
+    survivors = list(chunk_repo.collection.find({}, {"_id": 1, "embedding_index": 1}).sort("embedding_index", 1))
+    ids = [c.get("embedding_index") for c in survivors]
+    if len(set(ids)) != len(ids) or any(not isinstance(i, int) or not 0 <= i < index.ntotal for i in ids):
+        raise RuntimeError(f"embedding_index out of sync with FAISS index (ntotal={index.ntotal})")
+    if len(ids) == index.ntotal:
+        return index
+
+    if isinstance(index, faiss.IndexIVF):
+        # IVF cần direct map (id -> vị trí trong inverted list) mới reconstruct được
+        index.make_direct_map()
+    compacted = faiss.clone_index(index)
+    compacted.reset()
+    if ids:
+        xb = np.ascontiguousarray(index.reconstruct_batch(np.array(ids, dtype="int64")), dtype="float32")
+        compacted.add(xb)
+
+    bulk_ops = [
+        UpdateOne({"_id": c["_id"]}, {"$set": {"embedding_index": i}})
+        for i, c in enumerate(survivors) if c["embedding_index"] != i
+    ]
+    if bulk_ops:
+        chunk_repo.collection.bulk_write(bulk_ops)
+    _write_index(compacted)
+    if bulk_ops:
+        # embedding_index của sách khác bị dồn lại -> indices trong LLM cache không còn đúng
+        llm_cache.invalidate_all()
+    logger.info(f"Compacted FAISS index: dropped {index.ntotal - len(ids)} stale vectors, renumbered {len(bulk_ops)} chunks")
+    return compacted
+
+def migrate_faiss_index():
+    """
+    Gọi lúc startup: index trên đĩa còn metric L2 hoặc khác FAISS_INDEX_TYPE thì chuyển đổi.
+    Không reconstruct được (index không hỗ trợ) thì rebuild từ MongoDB.
+    """
+    if not os.path.exists(INDEX_PATH):
+        return
+    index = faiss.read_index(INDEX_PATH)
+    if _index_matches_config(index):
+        return
+    try:
+        _migrate_index(index)
+    except RuntimeError as e:
+        logger.warning(f"Cannot reconstruct vectors from legacy index ({e}), rebuilding from MongoDB")
+        rebuild_faiss_index()
+
 def rebuild_faiss_index():
     """
     Rebuild FAISS index từ tất cả chunks trong MongoDB.
@@ -42,6 +184,7 @@ def rebuild_faiss_index():
         # Create empty index or remove if exists
         if os.path.exists(INDEX_PATH):
             os.remove(INDEX_PATH)
+        llm_cache.invalidate_all()
         return
     
     logger.info(f"Rebuilding FAISS index from {len(all_chunks)} chunks in MongoDB")
@@ -67,12 +210,17 @@ def rebuild_faiss_index():
         logger.info(f"Updated {len(bulk_ops)} embedding_index values")
     
     # Create new index
-    index = faiss.IndexFlatL2(dim)
-    index.add(np.array(vectors, dtype="float32"))
+    xb = np.array(vectors, dtype="float32")
+    faiss.normalize_L2(xb)
+    index = _new_index(dim, len(xb))
+    if not index.is_trained:
+        index.train(xb)
+    index.add(xb)
     
     # Save index
-    os.makedirs(DATA_DIR, exist_ok=True)
-    faiss.write_index(index, INDEX_PATH)
+    _write_index(index)
+    # embedding_index của mọi sách vừa được đánh lại -> indices/distances trong LLM cache không còn đúng
+    llm_cache.invalidate_all()
     
     logger.info(f"Rebuilt FAISS index with {len(vectors)} vectors")
 
@@ -81,6 +229,25 @@ def rebuild_faiss_index():
 def _cache_key(book_name: str, grade_id: str, pdf_bytes: bytes) -> str:
     return hashlib.md5((book_name+grade_id+str(len(pdf_bytes))).encode()).hexdigest()
 
+# Tăng version khi parser thay đổi để tự động bỏ qua cache cũ
+PAGES_CACHE_VERSION = 2
+
+def _has_valid_structure(pages: List[Dict]) -> bool:
+    """
+    Kiểm tra chất lượng parse: 10 trang đầu có chapter/lesson hợp lệ không.
+    Invalid patterns: contains <<<, >>, or doesn't follow expected format
+    """
+    for p in pages[:10]:
+        ch = p.get("chapter", "").strip()
+        le = p.get("lesson", "").strip()
+        if ch and (ch.startswith("<<") or ch.startswith(">>") or
+                  (not ch.startswith("Chương") and not ch.startswith("Phần"))):
+            return False
+        if le and (le.startswith("<<") or le.startswith(">>") or
+                  not le.startswith("Bài")):
+            return False
+    return any(p.get("chapter") or p.get("lesson") for p in pages[:10])
+
 def _compute_book_id(book_name: str, grade: int) -> str:
     """
     Tạo book_id ổn định từ tên sách + grade (không phụ thuộc đường dẫn PDF).
@@ -122,11 +289,13 @@ def _build_page_assignments(structured: Dict) -> Dict[int, Dict[str, str]]:
 
     # Gán range chương
     chapter_ranges: List[tuple] = []  # (start, end, chapter)
+    chapter_end: Dict[str, Optional[int]] = {}
     for idx, (start_page, ch) in enumerate(chapter_order):
         end_page = None
         if idx + 1 < len(chapter_order):
             end_page = chapter_order[idx + 1][0] - 1
         chapter_ranges.append((start_page, end_page, ch))
+        chapter_end[ch] = end_page
 
     # Gán range bài trong mỗi chương
     lesson_ranges: List[tuple] = []  # (start, end, chapter, lesson)
@@ -137,20 +306,9 @@ def _build_page_assignments(structured: Dict) -> Dict[int, Dict[str, str]]:
                 end = pairs[i + 1][0] - 1
             else:
                 # Nếu là bài cuối, kết thúc tại end của chương (nếu có)
-                ch_range = next(((s, e, c) for (s, e, c) in chapter_ranges if c == ch), None)
-                if ch_range:
-                    end = ch_range[1]
+                end = chapter_end.get(ch)
             lesson_ranges.append((start, end, ch, title))
 
-    # Duyệt tạo page_map
-    def _in_range(p: int, rng: tuple) -> bool:
-        s, e = rng
-        if s is None:
-            return False
-        if e is None:
-            return p >= s
-        return s <= p <= e
-
     # Phủ bài trước, rồi fallback chương
     for (start, end, ch, le) in lesson_ranges:
         if start is None:
@@ -164,8 +322,7 @@ def _build_page_assignments(structured: Dict) -> Dict[int, Dict[str, str]]:
             continue
         last = start if end is None else end
         for p in range(start, last + 1):
-            if p not in page_map:
-                page_map[p] = {"chapter": ch, "lesson": None}
+            page_map.setdefault(p, {"chapter": ch, "lesson": None})
 
     return page_map
 
@@ -191,33 +348,33 @@ def ingest_pdf(
     key = _cache_key(book_name, grade_id, pdf_bytes)
     cache_file = os.path.join(CACHE_DIR, f"{key}_pages.json")
 
+    pages = None
+    mode = None
     if os.path.exists(cache_file) and not force_reparse:
-        pages = json.load(open(cache_file, "r", encoding="utf-8"))
+        with open(cache_file, "rb") as f:
+            cached = orjson.loads(f.read())
         logger.info(f"Loaded cached pages: {cache_file}")
-        # Kiểm tra chất lượng cache: có chapter/lesson hợp lệ không
-        # Invalid patterns: contains <<<, >>, or doesn't follow expected format
-        has_invalid = False
-        for p in pages[:10]:
-            ch = p.get("chapter", "").strip()
-            le = p.get("lesson", "").strip()
-            # Check for invalid patterns
-            if ch and (ch.startswith("<<") or ch.startswith(">>") or 
-                      (not ch.startswith("Chương") and not ch.startswith("Phần"))):
-                has_invalid = True
-                break
-            if le and (le.startswith("<<") or le.startswith(">>") or 
-                      not le.startswith("Bài")):
-                has_invalid = True
-                break
-        needs_reparse = not any(p.get("chapter") or p.get("lesson") for p in pages[:10]) or has_invalid
-        if needs_reparse:
-            logger.info("Cache lacks valid chapter/lesson info, re-parsing...")
-            pages = parse_pdf_bytes(pdf_bytes, lang="vie", prefer_text=True)
-            json.dump(pages, open(cache_file, "w", encoding="utf-8"), ensure_ascii=False)
-            logger.info(f"Re-cached pages with structure: {cache_file}")
-    else:
-        pages = parse_pdf_bytes(pdf_bytes, lang="vie", prefer_text=True)
-        json.dump(pages, open(cache_file, "w", encoding="utf-8"), ensure_ascii=False)
+        # text/OCR cố định theo file -> dùng lại, khỏi dò text layer khi parse lại
+        if isinstance(cached, dict):
+            mode = cached.get("mode")
+        # Cache cũ (list thuần / khác version) hoặc thiếu chapter/lesson hợp lệ -> parse lại
+        if isinstance(cached, dict) and cached.get("version") == PAGES_CACHE_VERSION and cached.get("has_structure"):
+            pages = cached["pages"]
+        else:
+            logger.info("Cache outdated or lacks valid chapter/lesson info, re-parsing...")
+
+    if pages is None:
+        if mode is None:
+            mode = detect_parse_mode(pdf_bytes, prefer_text=True)
+        pages = parse_pdf_bytes(pdf_bytes, lang="vie", prefer_text=True, mode=mode)
+        cached = {
+            "version": PAGES_CACHE_VERSION,
+            "mode": mode,
+            "has_structure": _has_valid_structure(pages),
+            "pages": pages,
+        }
+        with open(cache_file, "wb") as f:
+            f.write(orjson.dumps(cached))
         logger.info(f"Cached pages: {cache_file}")
 
     # Xây dựng cấu trúc chương/bài ưu tiên từ MỤC LỤC (nếu có)
@@ -229,9 +386,8 @@ def ingest_pdf(
 
     # Nếu có OpenAI key, nhờ LLM chuẩn hoá cấu trúc (kèm số trang)
     structured = {}
-    if toc and OPENAI_API_KEY:
+    if toc and _openai_client:
         try:
-            client = OpenAI(api_key=OPENAI_API_KEY)
             prompt = {
                 "instruction": (
                     "Bạn là trợ lý biên tập SGK. Dựa trên MỤC LỤC thô (có thể bị xuống dòng giữa chừng), "
@@ -250,7 +406,7 @@ def ingest_pdf(
                 ),
                 "raw_toc_text": raw_toc_text or json.dumps(toc, ensure_ascii=False)
             }
-            resp = client.chat.completions.create(
+            resp = _openai_client.chat.completions.create(
                 model=CHAT_MODEL,
                 messages=[
                     {"role": "system", "content": "Trả về JSON hợp lệ, không kèm giải thích."},
@@ -313,12 +469,28 @@ def ingest_pdf(
     chunk_repo.delete_chunks_by_book(book_id)
     chapter_repo.delete_chapters_by_book(book_id)
     lesson_repo.delete_lessons_by_book(book_id)
+    if was_existing:
+        llm_cache.invalidate_book(book_id)
     
     chunks = chunk_pages(pages, book_name, grade_number, size=800, overlap=100)
     texts = [c["text"] for c in chunks]
     vectors = embed_texts(texts)
     dim = len(vectors[0])
 
+    # Append vectors của sách mới vào FAISS index (không embed lại toàn bộ corpus). Chuẩn bị index
+    # trước khi đánh embedding_index cho chunk mới: ingest lại sách thì vector cũ của sách vẫn còn trong
+    # index -> compact (reconstruct vector còn lại). Chỉ rebuild khi index lệch với MongoDB.
+    index = _ensure_index(dim)
+    if not _index_matches_config(index):
+        index = _migrate_index(index)
+    needs_rebuild = False
+    if was_existing:
+        try:
+            index = _compact_index(index, chunk_repo)
+        except RuntimeError as e:
+            logger.warning(f"Cannot compact FAISS index ({e}), rebuilding after insert")
+            needs_rebuild = True
+
     # Get max embedding_index from existing chunks (if any)
     max_index = 0
     try:
@@ -327,16 +499,16 @@ def ingest_pdf(
             max_index = all_chunks[0].get("embedding_index", 0) + 1
     except Exception:
         pass
-    
-    # Add new chunks to MongoDB first
-    # (We'll rebuild FAISS index after inserting all chunks)
 
-    # Trang theo chương từ pages
+    # Trang theo chương từ pages (pages đã theo thứ tự trang -> list tự sắp xếp, chỉ cần bỏ trùng liền kề)
     chapter_pages: Dict[str, List[int]] = {}
     for p in pages:
         ch = p.get("chapter")
         if ch:
-            chapter_pages.setdefault(ch, set()).add(p.get("page_num"))
+            ch_pages = chapter_pages.setdefault(ch, [])
+            page_num = p.get("page_num")
+            if not ch_pages or ch_pages[-1] != page_num:
+                ch_pages.append(page_num)
     
     # Hợp nhất structured với pages (thêm pages, chunk counts sẽ điền sau)
     book_structure: Dict[str, Dict] = {}
@@ -344,7 +516,7 @@ def ingest_pdf(
         book_structure[ch] = {
             "lessons": {l: {"pages": ([] if not info.get("lesson_pages", {}).get(l) else [info["lesson_pages"][l]]), "chunks": 0} for l in info.get("lessons", [])},
             "total_chunks": 0,
-            "pages": sorted(list(chapter_pages.get(ch, set())))
+            "pages": chapter_pages.get(ch, [])
         }
     
     # Dùng mapping page->(chapter/lesson) từ TOC để override detect từ nội dung
@@ -363,6 +535,9 @@ def ingest_pdf(
     
     # Prepare chunks for insertion
     chunks_to_insert = []
+    chapter_counts: Counter = Counter()
+    lesson_counts: Counter = Counter()
+    lesson_pages: Dict[tuple, set] = defaultdict(set)
     for i, c in enumerate(chunks):
         # Override chapter/lesson theo TOC nếu có
         pnum = c.get("page")
@@ -383,21 +558,41 @@ def ingest_pdf(
         c["embedding_index"] = max_index + i
         chunks_to_insert.append(c)
         
-        # Cập nhật đếm chunks vào structure
-        ch = c.get("chapter")
-        le = c.get("lesson")
-        if ch and ch in book_structure:
-            meta_count = book_structure[ch]
-            meta_count["total_chunks"] += 1
-            if le and le in meta_count["lessons"]:
-                meta_count["lessons"][le]["chunks"] += 1
-                # thêm page
-                pages_dict = meta_count["lessons"][le]
-                if "pages" in pages_dict:
-                    pages_dict["pages"] = sorted(list(set(pages_dict["pages"] + [c.get("page")])))
+        # Đếm chunks theo chương/bài (ghi vào structure một lần sau vòng lặp)
+        ch = ch_title
+        le = le_title
+        if ch:
+            chapter_counts[ch] += 1
+            if le:
+                lesson_counts[(ch, le)] += 1
+                lesson_pages[(ch, le)].add(c.get("page"))
+
+    for ch, ch_structure in book_structure.items():
+        ch_structure["total_chunks"] = chapter_counts[ch]
+        for le, le_structure in ch_structure["lessons"].items():
+            le_structure["chunks"] = lesson_counts[(ch, le)]
+            chunk_pages_of_lesson = lesson_pages.get((ch, le))
+            if chunk_pages_of_lesson:
+                le_structure["pages"] = sorted(chunk_pages_of_lesson.union(le_structure["pages"]))
     
     # Insert chunks into MongoDB
     chunk_repo.insert_chunks(chunks_to_insert, book_id)
+
+    if needs_rebuild or index.ntotal != max_index:
+        logger.info(f"FAISS index out of sync (ntotal={index.ntotal}, expected={max_index}), rebuilding...")
+        rebuild_faiss_index()
+    else:
+        xb = np.array(vectors, dtype="float32")
+        faiss.normalize_L2(xb)
+        if not index.is_trained:
+            index.train(xb)
+        index.add(xb)
+        logger.info(f"Appended {len(vectors)} vectors to FAISS index (total: {index.ntotal})")
+        if _index_matches_config(index):
+            _write_index(index)
+        else:
+            # ivfpq: corpus vừa vượt _IVFPQ_MIN_TRAIN -> train IVF-PQ trên toàn bộ vector hiện có
+            _migrate_index(index)
     
     # Create chapters and lessons collections
     chapter_order = 0
@@ -0,0 +1,317 @@
+import copy
+import hashlib
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np, faiss, orjson
+from app.core.config import (
+    LLM_CACHE_INDEX_PATH, LLM_CACHE_DATA_PATH, LLM_CACHE_THRESHOLD, LLM_CACHE_BUCKET_SIZE,
+    LLM_CACHE_EXACT_MATCH_CHARS,
+)
+from app.core.logger import get_logger
+
+try:
+    import fcntl  # khoá file giữa các uvicorn worker (POSIX)
+except ImportError:
+    fcntl = None
+
+logger = get_logger(__name__)
+
+# Lưu xuống đĩa sau mỗi N lần store (index có thể vài chục MB, không ghi mỗi request)
+_SAVE_EVERY = 20
+
+# (book_id, chapter_id, lesson_id, k, digest ghi chú ngắn hoặc "")
+Bucket = Tuple[str, str, str, int, str]
+
+def cache_bucket(book_id: str, chapter_id: str, lesson_id: str, k: int, content: str) -> Bucket:
+    """
+    Key bucket của 1 rag_query. k nằm trong key: kết quả cache phải có đúng số distances/indices.
+    Ghi chú ngắn (< LLM_CACHE_EXACT_MATCH_CHARS) thì embedding gần như chỉ là tên chương/bài ->
+    thêm digest của ghi chú đã chuẩn hoá để chỉ khớp đúng ghi chú đó, không trả outline của ghi chú khác
+    """
+    normalized = " ".join((content or "").split()).lower()
+    digest = ""
+    if len(normalized) < LLM_CACHE_EXACT_MATCH_CHARS:
+        digest = hashlib.blake2b(normalized.encode("utf-8"), digest_size=8).hexdigest()
+    return (book_id, chapter_id, lesson_id, k, digest)
+
+class _CacheBucket:
+    """Các query đã trả lời của một bài học: IndexFlatIP + entries song song (entries[i] <-> vector i)"""
+
+    def __init__(self, dim: int):
+        self.index = faiss.IndexFlatIP(dim)
+        # {"id", "gen", "result"}: id để gộp với bản trên đĩa của worker khác, gen xem SemanticCache
+        self.entries: List[dict] = []
+        self.last_used: List[float] = []
+
+    def remove(self, pos: int) -> None:
+        # IndexFlat.remove_ids dồn các id phía sau lên -> vị trí khớp với del trên list
+        self.index.remove_ids(np.array([pos], dtype="int64"))
+        del self.entries[pos]
+        del self.last_used[pos]
+
+class SemanticCache:
+    """
+    Cache kết quả rag_query theo bucket (xem cache_bucket): query mới trong cùng bài học, cùng k
+    gần giống query đã trả lời (cosine >= threshold) thì trả lại kết quả cũ, bỏ qua cả FAISS lẫn LLM.
+
+    - Mỗi bucket một IndexFlatIP nhỏ trên query embedding đã normalize (inner product = cosine)
+    - Đầy (bucket_size) thì bỏ entry lâu không dùng nhất (LRU)
+    - Lưu xuống đĩa thành 1 index + 1 file JSON. Nhiều worker dùng chung file: lúc lưu, dưới khoá file,
+      đọc bản trên đĩa rồi gộp với entry trong bộ nhớ (theo id) thay vì ghi đè
+    - Vô hiệu hoá qua "generation" lưu ở file riêng: {"global": n, "books": {book_id: n}}. Mỗi entry mang
+      generation lúc store; xoá/ingest lại sách tăng generation của sách, đánh lại embedding_index (rebuild
+      FAISS) tăng global -> mọi worker thấy file generation đổi (stat mỗi lookup) và bỏ entry cũ
+    """
+
+    def __init__(self, index_path: str, data_path: str, threshold: float, bucket_size: int):
+        self.index_path = index_path
+        self.data_path = data_path
+        self.gen_path = f"{data_path}.gen"
+        self.lock_path = f"{data_path}.lock"
+        self.threshold = threshold
+        self.bucket_size = bucket_size
+        self.buckets: Dict[Bucket, _CacheBucket] = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._unsaved = 0
+        self._generations: Dict = {"global": 0, "books": {}}
+        self._gen_stamp: Optional[tuple] = ()
+
+    # ---------- generation ----------
+
+    def _read_generations(self) -> Dict:
+        try:
+            with open(self.gen_path, "rb") as f:
+                gens = orjson.loads(f.read())
+            return {"global": int(gens.get("global", 0)), "books": dict(gens.get("books") or {})}
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Cannot read LLM cache generations, assuming none: {e}")
+        return {"global": 0, "books": {}}
+
+    def _gen_of(self, book_id: str) -> List[int]:
+        return [self._generations["global"], self._generations["books"].get(book_id, 0)]
+
+    def _refresh_generations(self) -> None:
+        """Đọc lại file generation nếu worker khác vừa đổi, bỏ các bucket đã bị vô hiệu hoá"""
+        # File được thay bằng os.replace -> inode mới mỗi lần ghi; mtime một mình có thể trùng (độ phân giải thô)
+        try:
+            st = os.stat(self.gen_path)
+            stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._gen_stamp:
+            return
+        old = self._generations
+        self._generations = self._read_generations()
+        self._gen_stamp = stamp
+        if self._generations["global"] != old["global"]:
+            self.buckets.clear()
+            return
+        for key in [key for key in self.buckets if self._gen_of(key[0]) != [old["global"], old["books"].get(key[0], 0)]]:
+            del self.buckets[key]
+
+    def _is_current(self, rec: dict) -> bool:
+        bucket = rec.get("bucket") or ()
+        return len(bucket) == 5 and rec.get("gen") == self._gen_of(bucket[0])
+
+    # ---------- đĩa ----------
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """Khoá giữa các process trong lúc đọc-gộp-ghi; không có fcntl (Windows, 1 process) thì bỏ qua"""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.lock_path) or ".", exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _tmp_path(self, path: str) -> str:
+        # Tên file tạm riêng từng process: các worker không ghi đè file tạm của nhau
+        return f"{path}.{os.getpid()}.tmp"
+
+    def _read_disk(self) -> List[Tuple[np.ndarray, dict]]:
+        """[(vector, record)] đang lưu trên đĩa; record dạng cũ (không có id/gen) bị bỏ"""
+        if not (os.path.exists(self.index_path) and os.path.exists(self.data_path)):
+            return []
+        try:
+            index = faiss.read_index(self.index_path)
+            with open(self.data_path, "rb") as f:
+                data = orjson.loads(f.read())
+            records = data.get("records", []) if isinstance(data, dict) else []
+            if index.ntotal != len(records):
+                logger.warning(f"LLM cache mismatch ({index.ntotal} vectors vs {len(records)} entries), ignoring file")
+                return []
+            vectors = index.reconstruct_n(0, index.ntotal) if index.ntotal else []
+            return [(vec, rec) for vec, rec in zip(vectors, records) if rec.get("id")]
+        except Exception as e:
+            logger.warning(f"Failed to read LLM semantic cache: {e}")
+            return []
+
+    def _load(self) -> None:
+        self._loaded = True
+        self._refresh_generations()
+        # Khoá file: không đọc giữa 2 lần os.replace (index mới + JSON cũ) của worker khác
+        with self._file_lock():
+            stored = self._read_disk()
+        count = 0
+        for vec, rec in stored:
+            if not self._is_current(rec):
+                continue
+            self._add(tuple(rec["bucket"]), vec.reshape(1, -1), rec, rec.get("ts", 0.0))
+            count += 1
+        if count:
+            logger.info(f"Loaded LLM semantic cache with {count} entries in {len(self.buckets)} buckets")
+
+    def _add(self, bucket: Bucket, pv: np.ndarray, entry: dict, ts: float) -> None:
+        b = self.buckets.get(bucket)
+        if b is None or b.index.d != pv.shape[1]:
+            b = self.buckets[bucket] = _CacheBucket(pv.shape[1])
+        while b.index.ntotal >= self.bucket_size:
+            b.remove(int(np.argmin(b.last_used)))
+        b.index.add(pv)
+        b.entries.append({"id": entry["id"], "gen": entry["gen"], "result": entry["result"]})
+        b.last_used.append(ts)
+
+    def _ready(self) -> None:
+        if not self._loaded:
+            self._load()
+        else:
+            self._refresh_generations()
+
+    # ---------- API ----------
+
+    @staticmethod
+    def _prepare(vec: np.ndarray) -> np.ndarray:
+        pv = np.array(vec, dtype="float32").reshape(1, -1)
+        faiss.normalize_L2(pv)
+        return pv
+
+    def lookup(self, vec: np.ndarray, bucket: Bucket, threshold: Optional[float] = None) -> Optional[dict]:
+        """Trả về bản copy kết quả đã cache nếu bucket có query đủ giống, ngược lại None"""
+        threshold = self.threshold if threshold is None else threshold
+        pv = self._prepare(vec)
+        with self._lock:
+            self._ready()
+            b = self.buckets.get(bucket)
+            if b is None or b.index.ntotal == 0 or b.index.d != pv.shape[1]:
+                return None
+            D, I = b.index.search(pv, 1)
+            score, pos = float(D[0][0]), int(I[0][0])
+            if pos < 0 or score < threshold:
+                return None
+            b.last_used[pos] = time.time()
+            logger.info(f"LLM semantic cache hit for {bucket} (similarity={score:.4f})")
+            # Copy: caller có thể sửa outline trả về
+            return copy.deepcopy(b.entries[pos]["result"])
+
+    def store(self, vec: np.ndarray, bucket: Bucket, result: dict) -> None:
+        pv = self._prepare(vec)
+        with self._lock:
+            self._ready()
+            entry = {"id": uuid.uuid4().hex, "gen": self._gen_of(bucket[0]), "result": copy.deepcopy(result)}
+            self._add(bucket, pv, entry, time.time())
+            self._unsaved += 1
+            if self._unsaved >= _SAVE_EVERY:
+                with self._file_lock():
+                    self._save_locked()
+
+    def invalidate_book(self, book_id: str) -> None:
+        """Bỏ kết quả của sách ở mọi worker (xoá / ingest lại sách thì kết quả cũ không còn đúng)"""
+        self._bump(book_id)
+
+    def invalidate_all(self) -> None:
+        """Bỏ toàn bộ cache ở mọi worker (rebuild/compact FAISS đánh lại embedding_index của mọi sách)"""
+        self._bump(None)
+
+    def _bump(self, book_id: Optional[str]) -> None:
+        with self._lock:
+            self._ready()
+            with self._file_lock():
+                self._bump_locked(book_id)
+
+    def _bump_locked(self, book_id: Optional[str]) -> None:
+        gens = self._read_generations()
+        if book_id is None:
+            gens["global"] += 1
+        else:
+            gens["books"][book_id] = gens["books"].get(book_id, 0) + 1
+        try:
+            os.makedirs(os.path.dirname(self.gen_path) or ".", exist_ok=True)
+            tmp = self._tmp_path(self.gen_path)
+            with open(tmp, "wb") as f:
+                f.write(orjson.dumps(gens))
+            os.replace(tmp, self.gen_path)
+        except Exception as e:
+            logger.warning(f"Failed to persist LLM cache generations: {e}")
+        self._refresh_generations()
+        # Ghi lại file cache không còn entry cũ (cả entry của worker khác)
+        self._save_locked()
+        logger.info(f"Invalidated LLM cache ({'all books' if book_id is None else f'book {book_id}'})")
+
+    def save(self) -> None:
+        with self._lock:
+            if self._unsaved:
+                with self._file_lock():
+                    self._save_locked()
+
+    def _save_locked(self) -> None:
+        """Gộp bản trên đĩa + bộ nhớ rồi ghi; gọi khi đang giữ cả self._lock lẫn khoá file"""
+        try:
+            self._refresh_generations()
+            # id -> (vector, record); worker khác có thể đã lưu entry mà process này chưa thấy
+            merged: Dict[str, Tuple[np.ndarray, dict]] = {}
+            for vec, rec in self._read_disk():
+                if self._is_current(rec):
+                    merged[rec["id"]] = (vec, rec)
+            for key, b in self.buckets.items():
+                vectors = b.index.reconstruct_n(0, b.index.ntotal) if b.index.ntotal else []
+                for vec, entry, ts in zip(vectors, b.entries, b.last_used):
+                    prev = merged.get(entry["id"])
+                    if prev is not None:
+                        ts = max(ts, prev[1].get("ts", 0.0))
+                    merged[entry["id"]] = (vec, {**entry, "bucket": list(key), "ts": ts})
+
+            # Giới hạn bucket_size theo lần dùng gần nhất, chung cho mọi worker
+            by_bucket: Dict[tuple, List[Tuple[np.ndarray, dict]]] = {}
+            for vec, rec in merged.values():
+                by_bucket.setdefault(tuple(rec["bucket"]), []).append((vec, rec))
+            dim = next((len(vec) for vec, _ in merged.values()), None)
+            kept: List[Tuple[np.ndarray, dict]] = []
+            for items in by_bucket.values():
+                items.sort(key=lambda item: item[1].get("ts", 0.0), reverse=True)
+                kept.extend(item for item in items[:self.bucket_size] if len(item[0]) == dim)
+
+            index = faiss.IndexFlatIP(dim or 1)
+            if kept:
+                index.add(np.stack([vec for vec, _ in kept]).astype("float32"))
+            records = [rec for _, rec in kept]
+
+            os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+            tmp_index = self._tmp_path(self.index_path)
+            tmp_data = self._tmp_path(self.data_path)
+            faiss.write_index(index, tmp_index)
+            with open(tmp_data, "wb") as f:
+                f.write(orjson.dumps({"records": records}))
+            os.replace(tmp_index, self.index_path)
+            os.replace(tmp_data, self.data_path)
+            self._unsaved = 0
+        except Exception as e:
+            logger.warning(f"Failed to persist LLM semantic cache: {e}")
+
+llm_cache = SemanticCache(
+    index_path=LLM_CACHE_INDEX_PATH,
+    data_path=LLM_CACHE_DATA_PATH,
+    threshold=LLM_CACHE_THRESHOLD,
+    bucket_size=LLM_CACHE_BUCKET_SIZE,
+)
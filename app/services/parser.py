@@ -1,62 +1,191 @@
 import fitz  # PyMuPDF
-from pdf2image import convert_from_bytes
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import pytesseract
-from typing import List, Dict, Tuple
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Dict, Tuple, Optional
 import re
-from PIL import ImageFile
+import json
+import asyncio
+from PIL import Image, ImageFile
 from app.core.logger import get_logger
-from app.core.config import FORCE_OCR, OPENAI_API_KEY
-from openai import OpenAI
+from app.core.config import FORCE_OCR, OPENAI_API_KEY, PARSE_WORKERS, OCR_DPI, OCR_PSM
+from openai import AsyncOpenAI
+from app.services.async_utils import run_coroutine_sync
+
+try:
+    import re2 as _re_engine  # google-re2
+except ImportError:
+    _re_engine = re
+
+try:
+    import tesserocr  # Tesseract C API: load model 1 lần, OCR nhiều trang
+except ImportError:
+    tesserocr = None
 
 # Enable loading truncated images
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 logger = get_logger(__name__)
 
+# ============ Precompiled regexes (compile một lần, dùng cho mọi trang/dòng) ============
+_RE_WS = re.compile(r'\s+')
+_DEL_ANGLE_BRACKETS = str.maketrans('', '', '<>')
+_RE_TAIL_PAGENUM = re.compile(r'(\.{3,}\s*)?\d{1,3}\s*$')
+_RE_FIRST_CLAUSE = re.compile(r'([^.:\n]{10,200})(?:[.:\\n]|$)')
+_RE_TRAILING_NUMBER = re.compile(r'\s*\d+\s*$')
+_RE_EDGE_PUNCT = re.compile(r'^\W+|\W+$')
+
+# MỤC LỤC (theo từng dòng)
+_RE_TOC_HEADER = re.compile(r'MỤC\s*LỤC', re.IGNORECASE)
+# Phân loại mọi dòng mục lục bằng 1 regex gộp, chạy finditer 1 lần trên cả đoạn (mỗi dòng = 1 match,
+# m.lastgroup = loại dòng). Thứ tự alternation = thứ tự ưu tiên; [^\S\n] thay cho \s để không vượt dòng.
+#   chapter      : "Chương I. TÊN"        chapter_head: dòng bắt đầu "Chương " khác
+#   lesson       : "Bài 1. Tên"           lesson_head : dòng bắt đầu "Bài <số>" khác
+#   page         : số trang đứng riêng    text        : còn lại
+_RE_TOC_LINE = re.compile(
+    r'^(?:'
+    r'(?P<chapter>(?P<ch_kw>Chương|CHƯƠNG|Phần|PHẦN)[^\S\n]+(?P<ch_num>[IVXLCDM\d]+)(?:\.|[^\S\n])+(?P<ch_title>.{2,}))'
+    r'|(?P<chapter_head>(?:Chương|CHƯƠNG|Phần|PHẦN)[^\S\n].*)'
+    r'|(?P<lesson>(?:Bài|BÀI)[^\S\n]+(?P<le_num>\d+)(?:\.|[^\S\n])+(?P<le_title>.+))'
+    r'|(?P<lesson_head>(?:Bài|BÀI)[^\S\n]+\d.*)'
+    r'|(?P<page>\d{1,3})'
+    r'|(?P<text>.+)'
+    r')$',
+    re.MULTILINE,
+)
+_TOC_CHAPTER_START = ("chapter", "chapter_head")
+_TOC_LESSON_START = ("lesson", "lesson_head")
+_RE_TITLE_CONTINUATION = re.compile(r'^[A-Za-zÀ-Ỵà-ỹ0-9\\s\\.,]+$')
+_RE_TOC_PAGE_TAIL = re.compile(r'(\.{3,}\s*)?\d{1,3}$')
+
+# Chương/bài trong nội dung trang: chạy trên mọi trang nên dùng RE2 (DFA, tuyến tính, không backtracking)
+# nếu có google-re2. Các pattern không dùng lookahead/backref (đuôi kết thúc là group không bắt giữ),
+# flags viết inline -> tương thích cả RE2 lẫn re. Không có (?m) thì "$" của re khớp cả trước "\n" cuối
+# chuỗi, của RE2 thì không -> pattern bài viết rõ "\n?{END}" với {END} là cuối chuỗi tuyệt đối của
+# từng engine ("\Z" với re, "\z" với RE2) để 2 engine cho cùng kết quả.
+_LESSON_TAIL = r'[\.\s]+([^\n]*?)(?:\s+\d+\s*$|\n\s*\d+\s*$|\n?{END})'
+
+
+def _compile_heading(pattern: str, engine=None):
+    """Compile pattern tiêu đề bằng engine (mặc định _re_engine), thay {END} theo engine."""
+    engine = engine or _re_engine
+    return engine.compile(pattern.replace("{END}", r"\Z" if engine is re else r"\z"))
+
+
+_RE_CHAPTER_ROMAN = _re_engine.compile(
+    r'(?ims)CHƯƠNG\s+([IVXLCDM]+)[\.\s]+(.+?)(?:\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)'
+)
+_RE_CHAPTER_ARABIC = _re_engine.compile(
+    r'(?ims)Chương\s+(\d+)[\.\s]+(.+?)(?:\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)'
+)
+_RE_CHAPTER_PART = _re_engine.compile(
+    r'(?ims)PHẦN\s+([IVXLCDM\d]+)[\.\s]+(.+?)(?:\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)'
+)
+_RE_LESSON_UPPER = _compile_heading(r'(?i)BÀI\s+(\d+)' + _LESSON_TAIL)
+_RE_LESSON_ALT = _compile_heading(r'(?i)Bài\s+học\s+(\d+)' + _LESSON_TAIL)
+_RE_LESSON_SECTION = _compile_heading(r'§\s*(\d+)' + _LESSON_TAIL)
+# Anchor (tiền tố bắt buộc) của 6 pattern trên gộp trong 1 regex: 1 lượt quét/trang cho biết họ nào
+# xuất hiện và ở đâu -> chỉ chạy pattern đầy đủ (có capture) cho họ có anchor, bắt đầu từ anchor đầu tiên.
+# Các anchor loại trừ nhau nên finditer không che mất vị trí của họ khác.
+_RE_HEADING_ANCHOR = _re_engine.compile(
+    r'(?i)(?P<chapter_roman>CHƯƠNG\s+[IVXLCDM]+[\.\s])'
+    r'|(?P<chapter_arabic>Chương\s+\d+[\.\s])'
+    r'|(?P<chapter_part>PHẦN\s+[IVXLCDM\d]+[\.\s])'
+    r'|(?P<lesson_upper>BÀI\s+\d+[\.\s])'
+    r'|(?P<lesson_alt>Bài\s+học\s+\d+[\.\s])'
+    r'|(?P<lesson_section>§\s*\d+[\.\s])'
+)
+
+_MAX_HEADING_LEN = 200
+# Số tiêu đề mỗi request refine; các request chạy song song (AsyncOpenAI + asyncio.gather)
+_REFINE_BATCH_SIZE = 20
+
 def _heuristic_shorten_heading(text: str) -> str:
     """
     Heuristic rút gọn tiêu đề dài do OCR: bỏ đuôi dấu chấm dẫn/số trang, lấy đoạn ý chính đầu.
     """
     t = text.strip()
     # Bỏ đường chấm và số trang ở cuối: ....... 12
-    t = re.sub(r'(\.{3,}\s*)?\d{1,3}\s*$', '', t).strip()
+    t = _RE_TAIL_PAGENUM.sub('', t).strip()
     # Rút ngắn theo câu/dấu phân cách nếu quá dài
     if len(t) > 200:
-        m = re.search(r'([^.:\n]{10,200})(?:[.:\\n]|$)', t)
+        m = _RE_FIRST_CLAUSE.search(t)
         if m:
             t = m.group(1).strip()
-    t = re.sub(r'\s+', ' ', t)
+    t = _RE_WS.sub(' ', t)
     return t[:200].strip()
 
-def _refine_heading_with_llm(kind: str, raw: str) -> str:
-    """
-    Dùng OpenAI để rút gọn/chuẩn hoá tiêu đề chương/bài khi phát hiện quá dài (nhiễu OCR).
-    Nếu không có API key hoặc lỗi, fallback về heuristic.
-    """
-    cleaned = _heuristic_shorten_heading(raw)
-    if not OPENAI_API_KEY:
-        return cleaned
+async def _refine_batch_async(client: AsyncOpenAI, items: List[Tuple[str, str]]) -> Dict[str, str]:
+    """Refine 1 batch tiêu đề trong 1 request. Lỗi -> {} (batch đó giữ kết quả heuristic)"""
+    refined: Dict[str, str] = {}
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        listing = "\n".join(f"{i}. [{kind}] {raw}" for i, (kind, raw) in enumerate(items))
         prompt = (
-            f"Hãy rút gọn và chuẩn hoá tiêu đề {kind} dưới đây thành một dòng ngắn gọn, "
-            f"loại bỏ phần dư như mô tả/câu ví dụ/số trang... Chỉ trả về CHUỖI TIÊU ĐỀ, không giải thích.\n\n"
-            f"Tiêu đề gốc:\n{raw}"
+            "Hãy rút gọn và chuẩn hoá từng tiêu đề chương/bài dưới đây thành một dòng ngắn gọn, "
+            "loại bỏ phần dư như mô tả/câu ví dụ/số trang...\n"
+            'Trả về JSON object dạng {"0": "tiêu đề", "1": "tiêu đề", ...} với key là số thứ tự, không giải thích.\n\n'
+            f"Danh sách tiêu đề gốc:\n{listing}"
         )
-        resp = client.chat.completions.create(
+        resp = await client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[
-                {"role": "system", "content": "Bạn là bộ lọc tiêu đề. Chỉ trả về một dòng tiêu đề sạch."},
+                {"role": "system", "content": "Bạn là bộ lọc tiêu đề. Chỉ trả về JSON các dòng tiêu đề sạch."},
                 {"role": "user", "content": prompt},
             ],
             temperature=0,
+            response_format={"type": "json_object"},
         )
-        content = (resp.choices[0].message.content or "").strip()
-        content = re.sub(r'\s+', ' ', content)[:200].strip()
-        return content or cleaned
+        data = json.loads(resp.choices[0].message.content or "{}")
+        for i, (_, raw) in enumerate(items):
+            value = data.get(str(i))
+            if isinstance(value, str):
+                value = _RE_WS.sub(' ', value)[:_MAX_HEADING_LEN].strip()
+                if value:
+                    refined[raw] = value
     except Exception as e:
-        logger.warning(f"LLM refine heading failed: {e}")
-        return cleaned
+        logger.warning(f"LLM refine headings failed: {e}")
+    return refined
+
+async def _refine_all_async(items: List[Tuple[str, str]]) -> List[Dict[str, str]]:
+    # Client tạo trong event loop của lần chạy này (connection pool của httpx gắn với loop)
+    async with AsyncOpenAI(api_key=OPENAI_API_KEY) as client:
+        batches = [items[i:i + _REFINE_BATCH_SIZE] for i in range(0, len(items), _REFINE_BATCH_SIZE)]
+        return await asyncio.gather(*(_refine_batch_async(client, batch) for batch in batches))
+
+def _refine_headings_with_llm(items: List[Tuple[str, str]]) -> Dict[str, str]:
+    """
+    Dùng OpenAI để rút gọn/chuẩn hoá các tiêu đề chương/bài quá dài (nhiễu OCR).
+    Chia batch _REFINE_BATCH_SIZE tiêu đề/request, các request gửi đồng thời.
+    items: [(kind, raw)] với kind là "chương" | "bài"
+    Returns: {raw: tiêu đề đã chuẩn hoá}. Nếu không có API key hoặc lỗi, fallback về heuristic.
+    """
+    refined = {raw: _heuristic_shorten_heading(raw) for _, raw in items}
+    if not items or not OPENAI_API_KEY:
+        return refined
+    for batch_result in run_coroutine_sync(_refine_all_async(items)):
+        refined.update(batch_result)
+    return refined
+
+def _refine_long_headings(results: List[Dict]) -> None:
+    """
+    Gom các chapter/lesson quá dài của cả tài liệu -> refine 1 lần -> patch lại vào results (in-place)
+    """
+    pending: Dict[str, str] = {}
+    for result in results:
+        if len(result["chapter"]) > _MAX_HEADING_LEN:
+            pending.setdefault(result["chapter"], "chương")
+        if len(result["lesson"]) > _MAX_HEADING_LEN:
+            pending.setdefault(result["lesson"], "bài")
+    if not pending:
+        return
+    refined = _refine_headings_with_llm([(kind, raw) for raw, kind in pending.items()])
+    for result in results:
+        result["chapter"] = refined.get(result["chapter"], result["chapter"])
+        result["lesson"] = refined.get(result["lesson"], result["lesson"])
+    logger.info(f"Refined {len(pending)} long headings")
 
 def extract_toc_candidates(pages: List[Dict], max_scan_pages: int = 30) -> Dict[str, Dict] | tuple[Dict[str, Dict], str]:
     """
@@ -82,41 +211,45 @@ def extract_toc_candidates(pages: List[Dict], max_scan_pages: int = 30) -> Dict[
 
     # Cắt riêng khu vực có thể là MỤC LỤC
     # Tìm từ "MỤC LỤC" và lấy ~2000 ký tự sau đó, nếu có
-    m = re.search(r'MỤC\s*LỤC', head_text, re.IGNORECASE)
+    m = _RE_TOC_HEADER.search(head_text)
     candidate_text = head_text
     if m:
         start = m.start()
         candidate_text = head_text[start:start+8000]
 
-    # Chuẩn hoá xuống từng dòng để regex
+    # Chuẩn hoá xuống từng dòng, rồi phân loại tất cả các dòng trong 1 lượt finditer
     lines = [l.strip() for l in candidate_text.splitlines() if l.strip()]
+    tokens = [(m.lastgroup, m) for m in _RE_TOC_LINE.finditer("\n".join(lines))]
+
+    def _is_heading_start(kind: str, text: str) -> bool:
+        return kind in _TOC_LESSON_START or kind in _TOC_CHAPTER_START or "HOẠT ĐỘNG" in text.upper()
 
     current_chapter = None
     i = 0
-    while i < len(lines):
-        line = lines[i]
+    while i < len(tokens):
+        kind, m = tokens[i]
 
         # Dòng chương (có thể đa dòng)
-        ch = re.match(r'^(Chương|CHƯƠNG|Phần|PHẦN)\s+([IVXLCDM\d]+)[\.\s]+(.{2,})$', line)
-        if ch:
-            num = ch.group(2)
-            title = ch.group(3).strip()
+        if kind == "chapter":
+            num = m.group("ch_num")
+            title = m.group("ch_title").strip()
             # Gộp thêm 1-2 dòng tiếp theo nếu là phần tiếp của tiêu đề chương (thường toàn chữ hoa/khoảng trắng)
             j = i + 1
             join_parts = [title]
-            while j < len(lines) and j <= i + 3:
-                nxt = lines[j]
-                if re.match(r'^(Bài|BÀI)\s+\d+', nxt) or re.match(r'^(Chương|CHƯƠNG|Phần|PHẦN)\s+', nxt) or "HOẠT ĐỘNG" in nxt.upper():
+            while j < len(tokens) and j <= i + 3:
+                nxt_kind, nxt_m = tokens[j]
+                nxt = nxt_m.group()
+                if _is_heading_start(nxt_kind, nxt):
                     break
                 # Dòng toàn chữ/space hoặc quá ngắn được xem là tiếp tiêu đề
-                if re.match(r'^[A-Za-zÀ-Ỵà-ỹ0-9\\s\\.,]+$', nxt) or len(nxt) <= 40:
+                if _RE_TITLE_CONTINUATION.match(nxt) or len(nxt) <= 40:
                     join_parts.append(nxt.strip())
                     j += 1
                 else:
                     break
             title = " ".join(join_parts)
-            title = re.sub(r'(\.{3,}\s*)?\d{1,3}$', '', title).strip()
-            chapter_title = f"{ch.group(1).capitalize()} {num}. {title}".strip()
+            title = _RE_TOC_PAGE_TAIL.sub('', title).strip()
+            chapter_title = f"{m.group('ch_kw').capitalize()} {num}. {title}".strip()
             if chapter_title not in toc:
                 toc[chapter_title] = {"lessons": [], "chapter_first_page": None}
             current_chapter = chapter_title
@@ -124,33 +257,33 @@ def extract_toc_candidates(pages: List[Dict], max_scan_pages: int = 30) -> Dict[
             continue
 
         # Dòng bài học (có thể đa dòng, số trang có thể ở dòng sau)
-        le = re.match(r'^(Bài|BÀI)\s+(\d+)[\.\s]+(.+)$', line)
-        if le and current_chapter:
-            title_main = le.group(3).strip()
+        if kind == "lesson" and current_chapter:
+            title_main = m.group("le_title").strip()
             parts = [title_main]
             page_no = None
             j = i + 1
-            while j < len(lines) and j <= i + 3:
-                nxt = lines[j].strip()
+            while j < len(tokens) and j <= i + 3:
+                nxt_kind, nxt_m = tokens[j]
+                nxt = nxt_m.group()
                 # Nếu là số trang đứng riêng ở dòng tiếp theo
-                if re.match(r'^\d{1,3}$', nxt):
+                if nxt_kind == "page":
                     page_no = int(nxt)
                     j += 1
                     break
                 # Nếu gặp bắt đầu chương/bài mới thì dừng
-                if re.match(r'^(Bài|BÀI)\s+\d+', nxt) or re.match(r'^(Chương|CHƯƠNG|Phần|PHẦN)\s+', nxt) or "HOẠT ĐỘNG" in nxt.upper():
+                if _is_heading_start(nxt_kind, nxt):
                     break
                 # Ngược lại, nối tiếp tiêu đề bài
                 parts.append(nxt)
                 j += 1
             lesson_title = " ".join(parts)
-            lesson_title = re.sub(r'(\.{3,}\s*)?\d{1,3}$', '', lesson_title).strip()
+            lesson_title = _RE_TOC_PAGE_TAIL.sub('', lesson_title).strip()
             # Bỏ qua mục không phải bài học chính
             if lesson_title.lower().startswith("bài tập cuối") or "hoạt động" in lesson_title.lower() or "bảng tra" in lesson_title.lower() or "giải thích thuật ngữ" in lesson_title.lower():
                 i = j
                 continue
             toc[current_chapter]["lessons"].append({
-                "title": f"Bài {le.group(2)}. {lesson_title}",
+                "title": f"Bài {m.group('le_num')}. {lesson_title}",
                 "page": page_no
             })
             if toc[current_chapter]["chapter_first_page"] is None and page_no:
@@ -182,13 +315,30 @@ def _has_text_layer(doc: fitz.Document) -> bool:
             return True
     return False
 
+def _resolve_parse_mode(doc: fitz.Document, prefer_text: bool) -> str:
+    if prefer_text and not FORCE_OCR and _has_text_layer(doc):
+        return "text"
+    return "ocr"
+
+def detect_parse_mode(pdf_bytes: bytes, prefer_text: bool = True) -> str:
+    """
+    Xác định cách parse PDF: "text" (có text layer) hoặc "ocr".
+    Kết quả cố định theo từng file -> có thể cache lại và truyền vào parse_pdf_bytes(mode=...).
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        return _resolve_parse_mode(doc, prefer_text)
+    finally:
+        doc.close()
+
 def _clean_text(text: str) -> str:
     """Clean và normalize text"""
-    # Remove excessive whitespace
-    text = re.sub(r'\s+', ' ', text)
-    # Remove weird characters
-    text = re.sub(r'[<>]+', '', text)
-    return text.strip()
+    # Remove weird characters (<, >) rồi gộp khoảng trắng: str.translate + split/join chạy trong C, không qua regex
+    return ' '.join(text.translate(_DEL_ANGLE_BRACKETS).split())
+
+def _anchored_search(pattern, text: str, anchors: Dict[str, int], family: str):
+    pos = anchors.get(family)
+    return pattern.search(text, pos) if pos is not None else None
 
 def _detect_chapter_info(text: str, page_num: int) -> Tuple[str, str]:
     """
@@ -208,117 +358,100 @@ def _detect_chapter_info(text: str, page_num: int) -> Tuple[str, str]:
     # Clean text trước
     text = _clean_text(text)
     
+    # Lọc nhanh bằng tìm chuỗi con (C fastsearch): trang không có từ khoá nào thì không thể có heading
+    up = text.upper()
+    if not ("CHƯƠNG" in up or "PHẦN" in up or "BÀI" in up or "§" in up):
+        return chapter_name, lesson_name
+    
+    # Vị trí anchor đầu tiên của từng họ pattern (1 lượt quét cho cả trang)
+    anchors: Dict[str, int] = {}
+    for m in _RE_HEADING_ANCHOR.finditer(text):
+        anchors.setdefault(m.lastgroup, m.start())
+    if not anchors:
+        return chapter_name, lesson_name
+    
     # ============ DETECT CHAPTER ============
     # Pattern 1: "CHƯƠNG I. TÊN" (chữ hoa, số La Mã)
     # Stop at Bài, CHƯƠNG, etc.
-    match = re.search(
-        r'CHƯƠNG\s+([IVXLCDM]+)[\.\s]+(.+?)(?=\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)',
-        text,
-        re.IGNORECASE | re.DOTALL | re.MULTILINE
-    )
+    match = _anchored_search(_RE_CHAPTER_ROMAN, text, anchors, "chapter_roman")
     if match:
         num = match.group(1).upper()
         title = match.group(2).strip()
         # Validate: must have meaningful title (not just "Bài tập cuối")
         if title and len(title) > 3 and not title.startswith("tập"):
-            title = re.sub(r'\s*\d+\s*$', '', title)  # Remove page numbers at end
+            title = _RE_TRAILING_NUMBER.sub('', title)  # Remove page numbers at end
             chapter_name = f"Chương {num}. {title}"
             logger.debug(f"Page {page_num}: Detected chapter (Roman): '{chapter_name}'")
     
     # Pattern 2: "Chương 1. Tên" (chữ thường, số Ả-rập)
     if not chapter_name:
-        match = re.search(
-            r'Chương\s+(\d+)[\.\s]+(.+?)(?=\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)',
-            text,
-            re.IGNORECASE | re.DOTALL | re.MULTILINE
-        )
+        match = _anchored_search(_RE_CHAPTER_ARABIC, text, anchors, "chapter_arabic")
         if match:
             num = match.group(1)
             title = match.group(2).strip()
             if title and len(title) > 3 and not title.startswith("tập"):
-                title = re.sub(r'\s*\d+\s*$', '', title)
+                title = _RE_TRAILING_NUMBER.sub('', title)
                 chapter_name = f"Chương {num}. {title}"
                 logger.debug(f"Page {page_num}: Detected chapter (Arabic): '{chapter_name}'")
     
     # Pattern 3: "PHẦN I. TÊN" (một số SGK dùng "phần" thay vì "chương")
     if not chapter_name:
-        match = re.search(
-            r'PHẦN\s+([IVXLCDM\d]+)[\.\s]+(.+?)(?=\s+(?:Bài|BÀI|Chương|CHƯƠNG|Bài tập|HOẠT|\d+\s*$)|$)',
-            text,
-            re.IGNORECASE | re.DOTALL | re.MULTILINE
-        )
+        match = _anchored_search(_RE_CHAPTER_PART, text, anchors, "chapter_part")
         if match:
             num = match.group(1)
             title = match.group(2).strip()
             if title and len(title) > 3 and not title.startswith("tập"):
-                title = re.sub(r'\s*\d+\s*$', '', title)
+                title = _RE_TRAILING_NUMBER.sub('', title)
                 chapter_name = f"Phần {num}. {title}"
                 logger.debug(f"Page {page_num}: Detected chapter (Phần): '{chapter_name}'")
     
     # ============ DETECT LESSON ============
     # Pattern 1: "BÀI 1. TÊN BÀI" (chữ hoa)
     # Stop at page numbers or new lines with digits
-    match = re.search(
-        r'BÀI\s+(\d+)[\.\s]+([^\n]*?)(?=\s+\d+\s*$|\n\s*\d+\s*$|$)',
-        text,
-        re.IGNORECASE
-    )
+    match = _anchored_search(_RE_LESSON_UPPER, text, anchors, "lesson_upper")
     if match:
         num = match.group(1)
         title = match.group(2).strip()
         # Clean up title
-        title = re.sub(r'\s*\d+\s*$', '', title)  # Remove trailing page number
-        title = re.sub(r'^\W+|\W+$', '', title)  # Remove leading/trailing punctuation
+        title = _RE_TRAILING_NUMBER.sub('', title)  # Remove trailing page number
+        title = _RE_EDGE_PUNCT.sub('', title)  # Remove leading/trailing punctuation
         lesson_name = f"Bài {num}. {title}"
         logger.debug(f"Page {page_num}: Detected lesson: '{lesson_name}'")
     
     # Pattern 2: "Bài học 1. Tên" (một số SGK)
     if not lesson_name:
-        match = re.search(
-            r'Bài\s+học\s+(\d+)[\.\s]+([^\n]*?)(?=\s+\d+\s*$|\n\s*\d+\s*$|$)',
-            text,
-            re.IGNORECASE
-        )
+        match = _anchored_search(_RE_LESSON_ALT, text, anchors, "lesson_alt")
         if match:
             num = match.group(1)
             title = match.group(2).strip()
-            title = re.sub(r'\s*\d+\s*$', '', title)
+            title = _RE_TRAILING_NUMBER.sub('', title)
             lesson_name = f"Bài {num}. {title}"
             logger.debug(f"Page {page_num}: Detected lesson (alt): '{lesson_name}'")
     
     # Pattern 3: "§1. Tên" (ký hiệu đoạn)
     if not lesson_name:
-        match = re.search(
-            r'§\s*(\d+)[\.\s]+([^\n]*?)(?=\s+\d+\s*$|\n\s*\d+\s*$|$)',
-            text
-        )
+        match = _anchored_search(_RE_LESSON_SECTION, text, anchors, "lesson_section")
         if match:
             num = match.group(1)
             title = match.group(2).strip()
-            title = re.sub(r'\s*\d+\s*$', '', title)
+            title = _RE_TRAILING_NUMBER.sub('', title)
             lesson_name = f"Bài {num}. {title}"
             logger.debug(f"Page {page_num}: Detected lesson (§): '{lesson_name}'")
     
-    # Normalize/Refine lengths: dùng LLM khi quá dài (nghi nhiễu), fallback heuristic
-    MAX_LEN = 200
-    if len(chapter_name) > MAX_LEN:
-        chapter_name = _refine_heading_with_llm("chương", chapter_name)
-        logger.info(f"Page {page_num}: Chapter refined")
-    
-    if len(lesson_name) > MAX_LEN:
-        lesson_name = _refine_heading_with_llm("bài", lesson_name)
-        logger.info(f"Page {page_num}: Lesson refined")
-    
+    # Tiêu đề quá dài (nghi nhiễu) được giữ nguyên ở đây, parse_pdf_bytes gom lại
+    # và refine bằng LLM 1 lần cho cả tài liệu (_refine_long_headings)
     return chapter_name, lesson_name
 
-def _extract_text_with_structure(page: fitz.Page, page_num: int) -> Tuple[str, str, str]:
+def _extract_text_with_structure(page: fitz.Page, page_num: int) -> Tuple[str, List, str, str]:
     """
     Trích xuất text + detect structure từ 1 page
     
     Strategy:
     1. Get full text
-    2. Get blocks để tìm headings (font size lớn)
+    2. Get blocks để tìm headings (font size lớn) - get_text("dict") đắt nhất, chỉ gọi 1 lần/trang
     3. Combine headings + text → detect chapter/lesson
+    
+    Returns: (text, blocks, chapter, lesson)
     """
     # Get full text
     text = page.get_text("text")
@@ -345,9 +478,141 @@ def _extract_text_with_structure(page: fitz.Page, page_num: int) -> Tuple[str, s
     # Detect chapter/lesson
     chapter, lesson = _detect_chapter_info(search_text, page_num)
     
-    return text, chapter, lesson
+    return text, blocks, chapter, lesson
+
+# ===================== Parse theo trang (song song) =====================
+# Trang PDF độc lập nhau -> chia cho process pool; carry-forward chương/bài làm tuần tự ở process chính.
+# Mỗi worker mở PDF đúng 1 lần (initializer) thay vì pickle lại pdf_bytes cho từng trang.
+_PARALLEL_MIN_PAGES = 8
+_worker_doc: Optional[fitz.Document] = None
+_worker_keep_blocks = False
+_worker_lang = "vie"
+_worker_tess_api = None
+
+def _open_tess_api(lang: str):
+    """PyTessBaseAPI nếu có tesserocr + traineddata, ngược lại None (fallback pytesseract)"""
+    if tesserocr is None:
+        return None
+    try:
+        return tesserocr.PyTessBaseAPI(lang=lang, psm=OCR_PSM, oem=tesserocr.OEM.LSTM_ONLY)
+    except Exception as e:
+        logger.warning(f"tesserocr init failed (lang={lang}), falling back to pytesseract: {e}")
+        return None
+
+@contextmanager
+def _tess_api(lang: str) -> Iterator:
+    api = _open_tess_api(lang)
+    try:
+        yield api
+    finally:
+        if api is not None:
+            api.End()
+
+def _init_page_worker(pdf_bytes: bytes, keep_blocks: bool, lang: str) -> None:
+    global _worker_doc, _worker_keep_blocks, _worker_lang, _worker_tess_api
+    _worker_doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    _worker_keep_blocks = keep_blocks
+    _worker_lang = lang
+    # Mỗi process giữ 1 Tesseract API suốt vòng đời pool -> không load lại model mỗi trang
+    _worker_tess_api = _open_tess_api(lang)
+
+def _compact_blocks(blocks: List) -> List[Tuple[Tuple[float, float, float, float], float, str]]:
+    """
+    Rút gọn blocks của get_text("dict") (dict lồng nhau với font/color/flags/origin... cho từng span)
+    còn list tuple (bbox, font_size, text) cho từng span text
+    """
+    return [
+        (tuple(span.get("bbox", ())), span.get("size", 0), span.get("text", ""))
+        for block in blocks if block.get("type") == 0
+        for line in block.get("lines", [])
+        for span in line.get("spans", [])
+    ]
+
+def _parse_text_page(doc: fitz.Document, i: int, keep_blocks: bool) -> Dict:
+    """Parse 1 trang có text layer. chapter/lesson là giá trị detect được trên trang (chưa carry-forward)"""
+    text, blocks, chapter, lesson = _extract_text_with_structure(doc[i], i + 1)
+    return {
+        "text": text,
+        "blocks": _compact_blocks(blocks) if keep_blocks else None,
+        "chapter": chapter,
+        "lesson": lesson
+    }
+
+def _ocr_image(img, lang: str, api=None) -> str:
+    if api is not None:
+        api.SetImage(img)
+        return api.GetUTF8Text()
+    # pytesseract: mỗi lần gọi là 1 subprocess tesseract (load lại model)
+    return pytesseract.image_to_string(img, lang=lang, config=f"--oem 1 --psm {OCR_PSM}")
+
+def _render_page_image(page: fitz.Page, dpi: int = OCR_DPI) -> Image.Image:
+    """
+    Rasterize 1 trang bằng PyMuPDF (không cần Poppler); pixmap được giải phóng ngay sau khi copy sang PIL.
+    Grayscale: Tesseract cũng tự chuyển về xám, render 1 kênh thay vì 3 giảm 3x dữ liệu ảnh.
+    """
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def _ocr_page(doc: fitz.Document, i: int, lang: str, keep_blocks: bool, api=None) -> Dict:
+    """Render + OCR 1 trang; ảnh lỗi thì fallback text layer, cuối cùng trả trang rỗng để giữ số trang"""
+    try:
+        img = _render_page_image(doc[i])
+        txt = _ocr_image(img, lang, api)
+        del img
+        chapter, lesson = _detect_chapter_info(txt[:2000], i + 1)
+        return {"text": txt, "blocks": [] if keep_blocks else None, "chapter": chapter, "lesson": lesson}
+    except OSError as e:
+        logger.warning(f"⚠️ Page {i+1}: Image truncated or corrupted, skipping OCR. Error: {e}")
+        # Fallback: try to extract text directly from PDF if possible
+        try:
+            page = doc[i]
+            txt = page.get_text()
+            chapter, lesson = _detect_chapter_info(txt[:2000], i + 1)
+            return {
+                "text": txt,
+                "blocks": _compact_blocks(page.get_text("dict").get("blocks", [])) if keep_blocks else None,
+                "chapter": chapter,
+                "lesson": lesson
+            }
+        except Exception as e2:
+            logger.error(f"❌ Page {i+1}: Failed to extract text (OCR and PDF both failed). Error: {e2}")
+    except Exception as e:
+        logger.error(f"❌ Page {i+1}: Unexpected error during OCR. Error: {e}")
+    # Add empty page to maintain page numbering
+    return {"text": "", "blocks": [] if keep_blocks else None, "chapter": "", "lesson": ""}
+
+def _text_page_worker(i: int) -> Dict:
+    return _parse_text_page(_worker_doc, i, _worker_keep_blocks)
 
-def parse_pdf_bytes(pdf_bytes: bytes, lang: str = "vie", prefer_text: bool = True) -> List[Dict]:
+def _ocr_page_worker(i: int) -> Dict:
+    return _ocr_page(_worker_doc, i, _worker_lang, _worker_keep_blocks, _worker_tess_api)
+
+def _resolve_parse_workers(num_pages: int) -> int:
+    if num_pages < _PARALLEL_MIN_PAGES:
+        return 1
+    workers = PARSE_WORKERS or os.cpu_count() or 1
+    return max(1, min(workers, num_pages))
+
+def _map_pages(worker: Callable, items: List, pdf_bytes: bytes, keep_blocks: bool, lang: str, workers: int) -> List[Dict]:
+    """Chạy worker trên process pool, giữ nguyên thứ tự trang"""
+    # spawn: tránh fork process đang chạy nhiều thread (uvicorn, OpenAI client)
+    ctx = multiprocessing.get_context("spawn")
+    chunksize = max(1, len(items) // (workers * 4))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=ctx,
+        initializer=_init_page_worker,
+        initargs=(pdf_bytes, keep_blocks, lang),
+    ) as pool:
+        return list(pool.map(worker, items, chunksize=chunksize))
+
+def parse_pdf_bytes(
+    pdf_bytes: bytes,
+    lang: str = "vie",
+    prefer_text: bool = True,
+    mode: Optional[str] = None,
+    keep_blocks: bool = False,
+) -> List[Dict]:
     """
     Parse PDF với improved structure detection
     
@@ -356,11 +621,15 @@ def parse_pdf_bytes(pdf_bytes: bytes, lang: str = "vie", prefer_text: bool = Tru
     2. Validate chapter/lesson lengths
     3. Clean text (remove <>, excessive spaces)
     4. Debug logging
+    5. Parse song song theo trang (PARSE_WORKERS process)
+    
+    mode: "text" | "ocr" nếu đã biết trước (từ cache), bỏ qua bước dò text layer
+    keep_blocks: giữ thông tin span dạng gọn (mặc định bỏ để tiết kiệm RAM)
     
     Returns: List[Dict] với keys:
         - page_num: int
         - text: str
-        - blocks: List (raw block data)
+        - blocks: List[(bbox, font_size, text)] (chỉ có khi keep_blocks=True)
         - chapter: str (e.g., "Chương I. ỨNG DỤNG ĐẠO HÀM...")
         - lesson: str (e.g., "Bài 1. Tính đơn điệu và cực trị của hàm số")
     """
@@ -372,96 +641,56 @@ def parse_pdf_bytes(pdf_bytes: bytes, lang: str = "vie", prefer_text: bool = Tru
     current_lesson = ""
     
     try:
-        should_text = prefer_text and _has_text_layer(doc) and not FORCE_OCR
+        if mode is None:
+            mode = _resolve_parse_mode(doc, prefer_text)
+        should_text = mode == "text" and not FORCE_OCR
         
+        # Chỉ gửi số trang sang worker: worker tự đọc text / render ảnh từ doc của nó
+        items = list(range(len(doc)))
+        workers = _resolve_parse_workers(len(items))
         if should_text:
-            logger.info(f"Parsing {len(doc)} pages with TEXT layer")
-            
-            for i in range(len(doc)):
-                page = doc[i]
-                text, detected_chapter, detected_lesson = _extract_text_with_structure(page, i+1)
-                
-                # Update state khi detect được
-                if detected_chapter:
-                    current_chapter = detected_chapter
-                    logger.info(f"📘 Page {i+1}: Chapter = '{current_chapter}'")
-                
-                if detected_lesson:
-                    current_lesson = detected_lesson
-                    logger.info(f"📗 Page {i+1}: Lesson = '{current_lesson}'")
-                
-                pages.append({
-                    "page_num": i + 1,
-                    "text": text,
-                    "blocks": page.get_text("dict").get("blocks", []),
-                    "chapter": current_chapter,
-                    "lesson": current_lesson
-                })
-        
+            logger.info(f"Parsing {len(doc)} pages with TEXT layer ({workers} workers)")
+            worker = _text_page_worker
         else:
-            logger.info(f"Parsing {len(doc)} pages with OCR")
-            images = convert_from_bytes(pdf_bytes, dpi=300)
+            logger.info(f"Parsing {len(doc)} pages with OCR ({workers} workers)")
+            worker = _ocr_page_worker
+        
+        results = None
+        if workers > 1:
+            try:
+                results = _map_pages(worker, items, pdf_bytes, keep_blocks, lang, workers)
+            except BrokenProcessPool as e:
+                logger.warning(f"⚠️ Process pool failed, falling back to sequential parsing. Error: {e}")
+        if results is None:
+            if should_text:
+                results = [_parse_text_page(doc, i, keep_blocks) for i in items]
+            else:
+                # 1 Tesseract API cho cả vòng lặp tuần tự
+                with _tess_api(lang) as api:
+                    results = [_ocr_page(doc, i, lang, keep_blocks, api) for i in items]
+        
+        # Normalize/Refine lengths: dùng LLM khi quá dài (nghi nhiễu), fallback heuristic
+        _refine_long_headings(results)
+        
+        for i, result in enumerate(results):
+            # Update state khi detect được
+            if result["chapter"]:
+                current_chapter = result["chapter"]
+                logger.info(f"📘 Page {i+1}: Chapter = '{current_chapter}'")
             
-            for i, img in enumerate(images):
-                try:
-                    txt = pytesseract.image_to_string(img, lang=lang)
-                    detected_chapter, detected_lesson = _detect_chapter_info(txt[:2000], i+1)
-                    
-                    if detected_chapter:
-                        current_chapter = detected_chapter
-                        logger.info(f"📘 Page {i+1}: Chapter = '{current_chapter}'")
-                    
-                    if detected_lesson:
-                        current_lesson = detected_lesson
-                        logger.info(f"📗 Page {i+1}: Lesson = '{current_lesson}'")
-                    
-                    pages.append({
-                        "page_num": i + 1,
-                        "text": txt,
-                        "blocks": [],
-                        "chapter": current_chapter,
-                        "lesson": current_lesson
-                    })
-                except OSError as e:
-                    logger.warning(f"⚠️ Page {i+1}: Image truncated or corrupted, skipping OCR. Error: {e}")
-                    # Fallback: try to extract text directly from PDF if possible
-                    try:
-                        page = doc[i]
-                        txt = page.get_text()
-                        detected_chapter, detected_lesson = _detect_chapter_info(txt[:2000], i+1)
-                        
-                        if detected_chapter:
-                            current_chapter = detected_chapter
-                        if detected_lesson:
-                            current_lesson = detected_lesson
-                        
-                        pages.append({
-                            "page_num": i + 1,
-                            "text": txt,
-                            "blocks": page.get_text("dict").get("blocks", []),
-                            "chapter": current_chapter,
-                            "lesson": current_lesson
-                        })
-                    except Exception as e2:
-                        logger.error(f"❌ Page {i+1}: Failed to extract text (OCR and PDF both failed). Error: {e2}")
-                        # Add empty page to maintain page numbering
-                        pages.append({
-                            "page_num": i + 1,
-                            "text": "",
-                            "blocks": [],
-                            "chapter": current_chapter,
-                            "lesson": current_lesson
-                        })
-                except Exception as e:
-                    logger.error(f"❌ Page {i+1}: Unexpected error during OCR. Error: {e}")
-                    # Add empty page to maintain page numbering
-                    pages.append({
-                        "page_num": i + 1,
-                        "text": "",
-                        "blocks": [],
-                        "chapter": current_chapter,
-                        "lesson": current_lesson
-                    })
+            if result["lesson"]:
+                current_lesson = result["lesson"]
+                logger.info(f"📗 Page {i+1}: Lesson = '{current_lesson}'")
+            
+            page = {
+                "page_num": i + 1,
+                "text": result["text"],
+                "chapter": current_chapter,
+                "lesson": current_lesson
+            }
+            if keep_blocks:
+                page["blocks"] = result["blocks"]
+            pages.append(page)
         
         # Summary logging
         unique_chapters = {p["chapter"] for p in pages if p["chapter"]}
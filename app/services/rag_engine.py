@@ -1,210 +1,318 @@
-import json
 import os
-from typing import Tuple, List
-import numpy as np, faiss
+import threading
+from functools import lru_cache
+from typing import Any, Dict, Generator, Iterator, Tuple, List
+import faiss
+import orjson
 from openai import OpenAI
-from dotenv import load_dotenv
-from app.core.config import INDEX_PATH, CHAT_MODEL
+from app.core.config import (
+    OPENAI_API_KEY, INDEX_PATH, CHAT_MODEL, RAG_RELEVANCE_THRESHOLD, FAISS_HNSW_EF_SEARCH, FAISS_IVF_NPROBE,
+    FAISS_BATCH_WINDOW_MS, FAISS_BATCH_MAX_SIZE, FAISS_USE_GPU, FAISS_GPU_DEVICE,
+)
 from app.core.logger import get_logger
-from app.services.embedder import embed_query
+from app.services.embed_cache import cached_embed_query
+from app.services.llm_cache import llm_cache, cache_bucket as llm_cache_bucket
+from app.services.faiss_batcher import FaissBatcher
+from app.services.utils import run_parallel
+from app.services.entity_cache import (
+    cached_get_book, cached_get_chapter, cached_get_lesson,
+    cached_get_books, cached_get_chapters, cached_get_lessons,
+)
 from app.repositories.chunk_repository import ChunkRepository
-from app.repositories.book_repository import BookRepository
-from app.repositories.chapter_repository import ChapterRepository
-from app.repositories.lesson_repository import LessonRepository
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 logger = get_logger(__name__)
 
-# Load environment variables from .env if present
-load_dotenv()
-
-# MVP lesson DB (sẽ được thay bằng PostgreSQL sau)
-LESSONS = {
-    "L8-ALG-CH2-BT3": {
-        "name": "Phương trình bậc hai",
-        "grade": 8,
-        "chapter": "Chương 2",
-        "chapter_full": "Chương 2: Phương trình và hệ phương trình"
-    },
-    "L9-GEO-CH1-BT1": {
-        "name": "Định lý Pytago",
-        "grade": 9,
-        "chapter": "Chương 1",
-        "chapter_full": "Chương 1: Hệ thức lượng trong tam giác vuông"
-    }
-}
+# 1 client cho cả process (app/.env đã được load trong app.core.config): giữ connection pool /
+# keep-alive tới OpenAI giữa các request thay vì tạo client + TLS handshake mỗi lần gọi LLM
+_openai_client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
 
-def _get_lesson(lesson_id: str):
-    return LESSONS.get(lesson_id, {
-        "name": "",
-        "grade": 0,
-        "chapter": "",
-        "chapter_full": ""
-    })
+# Giới hạn nội dung mỗi chunk trong prompt theo token (LLM tính tiền / độ trễ theo token):
+# 5 chunk x 400 token = ~2000 token context. Không có tiktoken thì cắt 1200 ký tự như cũ
+_CHUNK_MAX_TOKENS = 400
+_CHUNK_MAX_CHARS = 1200
 
-def _load_index_chunks():
-    """Load FAISS index and get all chunks from MongoDB, sorted by embedding_index"""
-    if not os.path.exists(INDEX_PATH):
-        logger.error(f"FAISS index file not found: {INDEX_PATH}")
-        raise FileNotFoundError(f"FAISS index file not found: {INDEX_PATH}")
-    
-    index = faiss.read_index(INDEX_PATH)
-    num_vectors = index.ntotal
-    logger.info(f"Loaded FAISS index with {num_vectors} vectors from {INDEX_PATH}")
-    
-    chunk_repo = ChunkRepository()
-    # Get all chunks sorted by embedding_index to match FAISS index order
-    all_chunks = chunk_repo.collection.find({}).sort("embedding_index", 1)
-    chunks_list = list(all_chunks)
-    
-    logger.info(f"Loaded {len(chunks_list)} chunks from MongoDB")
-    
-    # Check if counts match
-    if num_vectors != len(chunks_list):
-        logger.warning(f"Mismatch: FAISS has {num_vectors} vectors but MongoDB has {len(chunks_list)} chunks")
-    
-    return index, chunks_list
+@lru_cache(maxsize=1)
+def _token_encoder():
+    """
+    Load encoding lần đầu cần dùng (không load lúc import): lần đầu tiktoken có thể phải tải
+    file BPE qua mạng, không để việc đó chặn startup của mọi worker. Lỗi -> None (cắt theo ký tự)
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(CHAT_MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"Cannot load tiktoken encoding, truncating context by characters: {e}")
+        return None
 
-def _build_prompt(chunks, lesson, teacher_notes):
+# Cache FAISS index giữa các query; index file đổi (ingest/xoá sách ghi lại index) -> load lại.
+# Không còn kéo toàn bộ chunks về: rag_query chỉ lấy chunk trúng qua get_chunks_by_indices.
+_index_cache = {"mtime": None, "index": None, "num_chunks": 0}
+_index_cache_lock = threading.Lock()
+# Read-only + mmap: OS chỉ page-in phần search chạm tới, các worker process dùng chung page cache.
+# IO_FLAG_MMAP_IFC (faiss >= 1.10) mmap luôn code của flat/SQ/PQ storage, bản cũ chỉ mmap inverted lists IVF
+_MMAP_READ_FLAGS = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_READ_ONLY", 0) | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+def _read_index_mmap(path: str):
+    try:
+        return faiss.read_index(path, _MMAP_READ_FLAGS)
+    except RuntimeError as e:
+        # Build FAISS không hỗ trợ tổ hợp flag này cho loại index trên đĩa -> đọc thường vào RAM
+        logger.warning(f"mmap read of FAISS index failed ({e}), loading it into memory")
+        return faiss.read_index(path)
+
+# StandardGpuResources phải sống cùng GPU index -> giữ 1 instance cho cả process
+_gpu_resources = None
+
+def _to_gpu(index):
     """
-    Build prompt với context từ chunks + lesson info
-    
-    NOTE: Prompt được thiết kế để:
-    - Chỉ dùng nội dung từ chunks (không bịa)
-    - Ưu tiên chunks có chapter/lesson info khớp
-    - Trả về JSON format cố định
+    Copy index sang GPU nếu có faiss-gpu + CUDA device; ngược lại (faiss-cpu, không có GPU,
+    loại index GPU không hỗ trợ như HNSW / flat SQ) giữ nguyên index CPU
     """
-    # Sort chunks by relevance (chunks có chapter/lesson info lên trước)
-    def score_chunk(c):
-        score = 0
-        if c.get("chapter"): score += 10
-        if c.get("lesson"): score += 5
-        return score
-    
-    chunks_sorted = sorted(chunks[:8], key=score_chunk, reverse=True)
-    
-    # Build context với annotations rõ ràng
-    # Lấy tên từ MongoDB collections
-    from app.repositories.book_repository import BookRepository
-    from app.repositories.chapter_repository import ChapterRepository
-    from app.repositories.lesson_repository import LessonRepository
-    
-    book_repo_ctx = BookRepository()
-    chapter_repo_ctx = ChapterRepository()
-    lesson_repo_ctx = LessonRepository()
+    global _gpu_resources
+    if not FAISS_USE_GPU or not hasattr(faiss, "StandardGpuResources") or faiss.get_num_gpus() == 0:
+        return index
+    try:
+        if _gpu_resources is None:
+            _gpu_resources = faiss.StandardGpuResources()
+        gpu_index = faiss.index_cpu_to_gpu(_gpu_resources, FAISS_GPU_DEVICE, index)
+        if isinstance(index, faiss.IndexIVF):
+            # GPU index không nhận SearchParametersIVF -> set nprobe trên index
+            faiss.GpuParameterSpace().set_index_parameter(gpu_index, "nprobe", FAISS_IVF_NPROBE)
+        logger.info(f"FAISS index moved to GPU {FAISS_GPU_DEVICE}")
+        return gpu_index
+    except Exception as e:
+        logger.warning(f"Cannot move FAISS index to GPU, searching on CPU: {e}")
+        return index
+
+def _load_index():
+    """Load FAISS index (cached theo mtime) + số chunks trong MongoDB để kiểm tra đồng bộ"""
+    if not os.path.exists(INDEX_PATH):
+        logger.error(f"FAISS index file not found: {INDEX_PATH}")
+        raise FileNotFoundError(f"FAISS index file not found: {INDEX_PATH}")
     
-    context_parts = []
-    for i, c in enumerate(chunks_sorted[:5]):  # Top 5 chunks
-        # Lấy book_name
-        chunk_book_id = c.get("book_id")
-        book_name = "N/A"
-        if chunk_book_id:
-            chunk_book = book_repo_ctx.get_book_by_id(chunk_book_id)
-            if chunk_book:
-                book_name = chunk_book.get("book_name", "N/A")
+    mtime = os.stat(INDEX_PATH).st_mtime_ns
+    with _index_cache_lock:
+        if _index_cache["mtime"] == mtime:
+            return _index_cache["index"], _index_cache["num_chunks"]
         
-        # Lấy chapter title
-        chunk_chapter_id = c.get("chapter_id")
-        chapter = "N/A"
-        if chunk_chapter_id:
-            chunk_chapter = chapter_repo_ctx.get_chapter_by_id(chunk_chapter_id)
-            if chunk_chapter:
-                chapter = chunk_chapter.get("title", "N/A")
+        index = _read_index_mmap(INDEX_PATH)
+        num_vectors = index.ntotal
+        logger.info(f"Loaded FAISS index with {num_vectors} vectors from {INDEX_PATH}")
+        index = _to_gpu(index)
         
-        # Lấy lesson title
-        chunk_lesson_id = c.get("lesson_id")
-        lesson_info = "N/A"
-        if chunk_lesson_id:
-            chunk_lesson = lesson_repo_ctx.get_lesson_by_id(chunk_lesson_id)
-            if chunk_lesson:
-                lesson_info = chunk_lesson.get("title", "N/A")
+        # Chỉ đếm (metadata của collection), không fetch documents
+        num_chunks = ChunkRepository().collection.estimated_document_count()
         
-        page = c.get("page", 0)
-        text = c.get("text", "")[:1200]  # Limit 1200 chars/chunk
+        # Check if counts match
+        if num_vectors != num_chunks:
+            logger.warning(f"Mismatch: FAISS has {num_vectors} vectors but MongoDB has {num_chunks} chunks")
         
-        context_parts.append(
-            f"--- Nguồn {i+1} ---\n"
-            f"Sách: {book_name}\n"
-            f"Chương: {chapter}\n"
-            f"Bài: {lesson_info}\n"
-            f"Trang: {page}\n"
-            f"Nội dung:\n{text}\n"
-        )
-    
-    context = "\n".join(context_parts)
-    
-    # Build prompt
-    prompt = f"""Bạn là giáo viên Toán giỏi. Nhiệm vụ: Tạo outline bài giảng CHỈ DỰA VÀO nội dung SGK bên dưới.
-
-**QUAN TRỌNG:**
+        _index_cache.update(mtime=mtime, index=index, num_chunks=num_chunks)
+        return index, num_chunks
 
-- CHỈ sử dụng thông tin từ "Nội dung SGK"
-- KHÔNG thêm kiến thức ngoài SGK
-- Nếu không đủ thông tin → Trả về {{"sections": [], "note": "Không đủ nội dung trong SGK"}}
+def warm_up_index() -> None:
+    """Load index lúc startup để request đầu không phải chờ đọc file / copy lên GPU"""
+    if not os.path.exists(INDEX_PATH):
+        return
+    try:
+        _load_index()
+    except Exception as e:
+        logger.warning(f"Failed to preload FAISS index: {e}")
 
-===== NỘI DUNG SGK =====
+def _search_params(index, k: int):
+    """
+    SearchParameters truyền theo từng lần search (không sửa index dùng chung giữa các request)
+    """
+    if isinstance(index, faiss.IndexHNSW):
+        # efSearch phải >= k
+        return faiss.SearchParametersHNSW(efSearch=max(FAISS_HNSW_EF_SEARCH, k))
+    if isinstance(index, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=FAISS_IVF_NPROBE)
+    return None
 
-{context}
+# Gom các query đồng thời thành 1 lần search (B, d)
+_faiss_batcher = FaissBatcher(
+    window_ms=FAISS_BATCH_WINDOW_MS,
+    max_batch=FAISS_BATCH_MAX_SIZE,
+    params_fn=_search_params,
+)
 
-===========================
+# System prompt tĩnh (giống nhau mọi request) đặt ĐẦU messages để OpenAI prompt caching
+# match được prefix; phần động (bài học, ghi chú giáo viên) luôn nằm CUỐI.
+SYSTEM_PROMPT = """Bạn là giáo viên Toán giỏi và là trợ lý giáo viên. CHỈ trích dẫn nội dung đã cho, KHÔNG bịa thêm.
+Nhiệm vụ: Tạo outline bài giảng CHỈ DỰA VÀO nội dung SGK được cung cấp.
 
-**YÊU CẦU:**
+**QUAN TRỌNG:**
 
-Tạo outline cho bài "{lesson['name']}" (Lớp {lesson['grade']}, {lesson.get('chapter_full', lesson.get('chapter', ''))})
+- CHỈ sử dụng thông tin từ "Nội dung SGK"
+- KHÔNG thêm kiến thức ngoài SGK
+- Nếu không đủ thông tin → Trả về {"sections": [], "note": "Không đủ nội dung trong SGK"}
 
-Cấu trúc:
+**CẤU TRÚC OUTLINE:**
 
 - 5-10 mục chính
 - Mỗi mục: Tiêu đề + 3-5 bullet points
-- Thêm ví dụ thực tế (gợi ý từ giáo viên: "{teacher_notes}")
+- Thêm ví dụ thực tế (theo gợi ý của giáo viên nếu có)
 
 **OUTPUT (JSON duy nhất):**
 
-{{
+{
   "sections": [
-    {{
+    {
       "title": "Tiêu đề mục 1",
       "bullets": ["Điểm 1", "Điểm 2", "Điểm 3"],
       "examples": ["Ví dụ 1: x² - 4 = 0"]
-    }}
+    }
   ]
-}}
+}
+"""
+
+def _fetch_titles(chunks: List[dict]) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
+    """
+    Tên sách / chương / bài cho các chunk: gom id rồi tra cache, phần miss lấy bằng 3 query $in
+    
+    Returns: (book_names, chapter_titles, lesson_titles) theo id
+    """
+    book_ids = {c["book_id"] for c in chunks if c.get("book_id")}
+    chapter_ids = {c["chapter_id"] for c in chunks if c.get("chapter_id")}
+    lesson_ids = {c["lesson_id"] for c in chunks if c.get("lesson_id")}
+    
+    book_names = {bid: b.get("book_name", "N/A") for bid, b in cached_get_books(book_ids).items()}
+    chapter_titles = {cid: ch.get("title", "N/A") for cid, ch in cached_get_chapters(chapter_ids).items()}
+    lesson_titles = {lid: le.get("title", "N/A") for lid, le in cached_get_lessons(lesson_ids).items()}
+    return book_names, chapter_titles, lesson_titles
+
+def _metadata_score_key(c: dict) -> int:
+    return c.get("metadata_score", 0)
+
+def _build_prompt(chunks, lesson, teacher_notes, titles) -> Tuple[str, str]:
+    """
+    Build prompt với context từ chunks + lesson info
+    
+    titles: kết quả _fetch_titles (tên sách/chương/bài theo id)
+    
+    Returns: (static_prefix, dynamic_suffix) - context SGK trước, yêu cầu động sau
+    
+    NOTE: Prompt được thiết kế để:
+    - Chỉ dùng nội dung từ chunks (không bịa)
+    - Ưu tiên chunks có chapter/lesson info khớp
+    - Trả về JSON format cố định
+    """
+    # Chunks có chapter/lesson info lên trước: metadata_score tính sẵn lúc ingest;
+    # sort stable -> cùng score thì giữ thứ tự similarity từ FAISS
+    chunks_sorted = sorted(chunks[:8], key=_metadata_score_key, reverse=True)
+    
+    # Build context với annotations rõ ràng
+    book_names, chapter_titles, lesson_titles = titles
+    
+    # Prefix: context SGK (chỉ phụ thuộc chunks) -> dùng lại được giữa các request cùng nguồn.
+    # Ghi từng mảnh vào 1 list rồi join 1 lần (không tạo chuỗi trung gian cho từng nguồn / context)
+    parts = ["===== NỘI DUNG SGK =====\n\n"]
+    for i, c in enumerate(chunks_sorted[:5]):  # Top 5 chunks
+        if i:
+            parts.append("\n")
+        parts += (
+            "--- Nguồn ", str(i + 1), " ---\n",
+            "Sách: ", str(book_names.get(c.get("book_id"), "N/A")), "\n",
+            "Chương: ", str(chapter_titles.get(c.get("chapter_id"), "N/A")), "\n",
+            "Bài: ", str(lesson_titles.get(c.get("lesson_id"), "N/A")), "\n",
+            "Trang: ", str(c.get("page", 0)), "\n",
+            "Nội dung:\n", _truncate_chunk_text(c.get("text", "")), "\n",
+        )
+    parts.append("\n\n===========================")
+    static_prefix = "".join(parts)
+    
+    # Suffix: phần thay đổi theo từng request
+    dynamic_suffix = f"""**YÊU CẦU:**
+
+Tạo outline cho bài "{lesson['name']}" (Lớp {lesson['grade']}, {lesson.get('chapter_full', lesson.get('chapter', ''))})
 
+Gợi ý ví dụ từ giáo viên: "{teacher_notes}"
 """
-    return prompt
+    return static_prefix, dynamic_suffix
 
-def _call_llm(prompt: str) -> dict:
+def _truncate_chunk_text(text: str) -> str:
+    encoder = _token_encoder()
+    if encoder is None:
+        return text[:_CHUNK_MAX_CHARS]
+    # BPE theo byte: mỗi token >= 1 byte UTF-8 (chữ tiếng Việt có dấu thường 2-3 token/ký tự),
+    # nên chỉ số byte mới là cận trên an toàn để bỏ qua encode
+    if len(text.encode("utf-8")) <= _CHUNK_MAX_TOKENS:
+        return text
+    tokens = encoder.encode(text)
+    if len(tokens) <= _CHUNK_MAX_TOKENS:
+        return text
+    return encoder.decode(tokens[:_CHUNK_MAX_TOKENS])
+
+def _dedupe_chunks(chunks: List[dict]) -> List[dict]:
+    """
+    Bỏ chunk trùng (cùng sách + trang + 64 ký tự đầu, thường do cửa sổ chunk chồng lấn)
+    trước khi đưa vào prompt, giữ nguyên thứ tự relevance
+    """
+    seen = set()
+    deduped = []
+    for c in chunks:
+        key = (c.get("book_id"), c.get("page"), (c.get("text") or "")[:64])
+        if key in seen:
+            continue
+        seen.add(key)
+        deduped.append(c)
+    return deduped
+
+def _parse_outline(content: str) -> dict:
+    """Parse JSON outline từ output LLM (orjson: nhanh hơn json stdlib với output vài KB)"""
+    return orjson.loads(content)
+
+def _call_llm_stream(static_prefix: str, dynamic_suffix: str) -> Generator[str, None, dict]:
     """
     Call LLM với safeguards:
     - Temperature=0 (minimize hallucination)
     - JSON format enforcement
-    - Retry logic (TODO: add retry)
+    - Lỗi kết nối / 429 / 5xx trước khi stream bắt đầu: OpenAI client tự retry (max_retries mặc định);
+      đã yield cho client rồi thì không retry được, trả outline lỗi
+    
+    stream=True: yield từng đoạn text ngay khi OpenAI trả về, gom lại rồi parse JSON;
+    outline (hoặc outline lỗi) là giá trị return của generator
     """
     try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if _openai_client is None:
             logger.error("OPENAI_API_KEY is not set. Skipping LLM call.")
             return {
                 "sections": [],
                 "note": "Thiếu cấu hình OPENAI_API_KEY. Vui lòng thêm vào file .env trong thư mục app/."
             }
 
-        client = OpenAI(api_key=api_key)
-        resp = client.chat.completions.create(
+        stream = _openai_client.chat.completions.create(
             model=CHAT_MODEL,
             messages=[
-                {
-                    "role": "system",
-                    "content": "Bạn là trợ lý giáo viên. CHỈ trích dẫn nội dung đã cho, KHÔNG bịa thêm."
-                },
-                {"role": "user", "content": prompt}
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": static_prefix},
+                {"role": "user", "content": dynamic_suffix}
             ],
             temperature=0,  # Zero creativity = stick to facts
-            response_format={"type": "json_object"}
+            response_format={"type": "json_object"},
+            stream=True
         )
-        content = resp.choices[0].message.content
-        return json.loads(content)
-    
-    except json.JSONDecodeError as e:
+        buffer = []
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                buffer.append(delta)
+                yield delta
+        return _parse_outline("".join(buffer))
+    
+    except orjson.JSONDecodeError as e:
         logger.error(f"LLM returned invalid JSON: {e}")
         return {
             "sections": [],
@@ -217,69 +325,42 @@ def _call_llm(prompt: str) -> dict:
             "note": f"Lỗi gọi AI: {str(e)}"
         }
 
-def _filter_chunks_by_metadata(chunks: List, lesson: dict) -> List:
-    """
-    Filter chunks theo grade + chapter để tránh nhầm lẫn giữa các lớp/chương
-    
-    Priority:
-    1. Exact match: grade=8 AND chapter="Chương 2"
-    2. Grade match only: grade=8 (nếu không có chapter info)
-    3. No filter (fallback)
-    """
-    target_grade = lesson.get("grade")
-    target_chapter = lesson.get("chapter", "")  # "Chương 2"
-    
-    if not target_grade:
-        return chunks  # No lesson info, return all
-    
-    # Level 1: Filter by grade + chapter
-    if target_chapter:
-        exact_match = [
-            c for c in chunks
-            if c.get("grade") == target_grade and target_chapter in c.get("chapter", "")
-        ]
-        if exact_match:
-            logger.info(f"Filtered to {len(exact_match)}/{len(chunks)} chunks (grade={target_grade}, chapter={target_chapter})")
-            return exact_match
-    
-    # Level 2: Filter by grade only
-    grade_match = [c for c in chunks if c.get("grade") == target_grade]
-    if grade_match:
-        logger.info(f"Filtered to {len(grade_match)}/{len(chunks)} chunks (grade={target_grade} only)")
-        return grade_match
-    
-    # Level 3: No filter (fallback)
-    logger.warning(f"No chunks match grade={target_grade}, using all {len(chunks)} chunks")
-    return chunks
+def _call_llm(static_prefix: str, dynamic_suffix: str) -> dict:
+    """Gọi LLM, chờ đủ output rồi trả outline (không cần stream từng đoạn)"""
+    llm = _call_llm_stream(static_prefix, dynamic_suffix)
+    while True:
+        try:
+            next(llm)
+        except StopIteration as done:
+            return done.value
 
-def rag_query(grade: int, book_id: str, chapter_id: str, lesson_id: str, content: str, k: int = 8) -> Tuple[dict, List[float], List[int]]:
+def _retrieve(grade: int, book_id: str, chapter_id: str, lesson_id: str, content: str, k: int) -> dict:
     """
-    RAG Query với filtering theo book_id, chapter_id, lesson_id
+    Phần trước LLM của RAG query: embed, semantic cache, FAISS, lọc chunk, build prompt
+    
+    Returns: {"result": (outline, dists, idxs)} nếu trả lời được luôn (cache hit / lỗi / không đủ liên quan),
+    ngược lại context để gọi LLM rồi _finalize
     """
-    # Get lesson info from MongoDB
-    lesson_repo = LessonRepository()
-    lesson = lesson_repo.get_lesson_by_id(lesson_id)
+    # Lesson / chapter / book không phụ thuộc nhau -> lấy đồng thời (cache miss = 3 round-trip MongoDB song song)
+    lesson, chapter, book = run_parallel(
+        lambda: cached_get_lesson(lesson_id),
+        lambda: cached_get_chapter(chapter_id),
+        lambda: cached_get_book(book_id),
+    )
     
     if not lesson:
-        return {
+        return {"result": ({
             "sections": [],
             "note": f"Lesson '{lesson_id}' not found",
             "sources": []
-        }, [], []
-    
-    # Get chapter info
-    chapter_repo = ChapterRepository()
-    chapter = chapter_repo.get_chapter_by_id(chapter_id)
+        }, [], [])}
     
-    # Get book info (for validation)
-    book_repo = BookRepository()
-    book = book_repo.get_book_by_id(book_id)
     if not book:
-        return {
+        return {"result": ({
             "sections": [],
             "note": f"Book '{book_id}' not found",
             "sources": []
-        }, [], []
+        }, [], [])}
     
     # Build query string
     query_parts = []
@@ -292,32 +373,39 @@ def rag_query(grade: int, book_id: str, chapter_id: str, lesson_id: str, content
     query_string = " ".join(query_parts).strip()
     logger.info(f"RAG Query: book_id={book_id}, chapter_id={chapter_id}, lesson_id={lesson_id}, query='{query_string}'")
     
-    # Embed query
-    qvec = np.array(embed_query(query_string), dtype="float32").reshape(1, -1)
+    # Embed query (cache LRU/Redis: cùng lesson + ghi chú thì không gọi lại OpenAI)
+    # Vector trả về đã normalize sẵn (inner product = cosine), read-only
+    qvec = cached_embed_query(query_string).reshape(1, -1)
+    
+    # Semantic cache theo bài học + k (+ ghi chú nếu ngắn): query gần giống đã trả lời (cosine >= LLM_CACHE_THRESHOLD)
+    # -> trả lại kết quả cũ, bỏ qua FAISS + LLM
+    cache_bucket = llm_cache_bucket(book_id, chapter_id, lesson_id, k, content)
+    cached = llm_cache.lookup(qvec, cache_bucket)
+    if cached is not None:
+        return {"result": (cached["outline"], cached["distances"], cached["indices"])}
     
-    # Load index + chunks from MongoDB
-    index, all_chunks = _load_index_chunks()
+    # Load index (cached) + số chunks trong MongoDB
+    index, num_chunks_in_db = _load_index()
     num_vectors_in_index = index.ntotal  # Total vectors in FAISS index
-    num_chunks_in_db = len(all_chunks)  # Chunks in MongoDB
     
     logger.info(f"FAISS index has {num_vectors_in_index} vectors, MongoDB has {num_chunks_in_db} chunks")
     
     if num_vectors_in_index == 0:
         logger.error("FAISS index is empty")
-        return {
+        return {"result": ({
             "sections": [],
             "note": "Chưa có dữ liệu SGK. Vui lòng ingest sách trước.",
             "sources": []
-        }, [], []
+        }, [], [])}
     
     # FAISS search - use num_vectors_in_index for k_search
     k_search = min(k * 3, num_vectors_in_index)  # Search more, filter later
     logger.info(f"Searching FAISS with k_search={k_search}, num_vectors={num_vectors_in_index}")
     
     try:
-        distances, indices = index.search(qvec, k_search)
+        distances, indices = _faiss_batcher.search(index, qvec, k_search)
         idxs = indices[0].tolist()
-        dists = distances[0].tolist()
+        dists = distances[0].tolist()  # Inner product trên vector đã normalize = cosine similarity
         
         logger.info(f"FAISS returned {len(idxs)} indices: {idxs[:5]}... (showing first 5)")
         
@@ -332,74 +420,47 @@ def rag_query(grade: int, book_id: str, chapter_id: str, lesson_id: str, content
         
         if not valid_pairs:
             logger.error(f"FAISS returned no valid indices. Raw indices: {idxs[:10]}, num_vectors: {num_vectors_in_index}")
-            return {
+            return {"result": ({
                 "sections": [],
                 "note": "Lỗi tìm kiếm. Vui lòng thử lại.",
                 "sources": []
-            }, [], []
+            }, [], [])}
     except Exception as e:
         logger.error(f"FAISS search failed: {e}")
-        return {
+        return {"result": ({
             "sections": [],
             "note": f"Lỗi tìm kiếm: {str(e)}",
             "sources": []
-        }, [], []
+        }, [], [])}
     
-    # Sort by distance (lower = better for L2)
-    valid_pairs.sort(key=lambda x: x[1])
+    # Sort by similarity (higher = better for inner product)
+    valid_pairs.sort(key=lambda x: x[1], reverse=True)
     idxs = [idx for idx, _ in valid_pairs]
     dists = [dist for _, dist in valid_pairs]
+    # Điểm theo embedding_index: sau khi lọc, thứ tự chunk không còn khớp vị trí trong dists
+    score_by_index = dict(valid_pairs)
     
-    # Get chunks by embedding indices from MongoDB
-    # Note: We query by embedding_index, not by position in array
-    chunk_repo = ChunkRepository()
-    retrieved_chunks = chunk_repo.get_chunks_by_indices(idxs)
-    
-    logger.info(f"Retrieved {len(retrieved_chunks)} chunks from MongoDB (requested {len(idxs)} indices), filtering by book_id={book_id}, chapter_id={chapter_id}, lesson_id={lesson_id}")
-    
-    # Debug: Check what book_id/chapter_id/lesson_id the chunks have
-    if retrieved_chunks:
-        sample_chunk = retrieved_chunks[0]
-        logger.info(f"Sample chunk: embedding_index={sample_chunk.get('embedding_index')}, book_id={sample_chunk.get('book_id')}, chapter_id={sample_chunk.get('chapter_id')}, lesson_id={sample_chunk.get('lesson_id')}")
-    else:
-        logger.warning(f"No chunks found for indices: {idxs[:10]}... (showing first 10)")
-    
-    # Filter by book_id, chapter_id, lesson_id
-    filtered_chunks = [
-        c for c in retrieved_chunks
-        if c.get("book_id") == book_id 
-        and c.get("chapter_id") == chapter_id
-        and c.get("lesson_id") == lesson_id
-    ]
-    
-    logger.info(f"After exact filter: {len(filtered_chunks)} chunks match")
+    # Get chunks by embedding indices from MongoDB: 1 query lọc book_id (index {book_id, ...,
+    # embedding_index}), giữ thứ tự similarity của idxs; chọn tier chapter/lesson trong 1 lượt
+    book_chunks = ChunkRepository().get_chunks_by_indices_filtered(idxs, book_id)
+    filtered_chunks, tier = _select_best_tier(book_chunks, chapter_id, lesson_id)
+    logger.info(f"Filtered to {len(filtered_chunks)}/{len(book_chunks)} chunks of book {book_id} (matched by {tier})")
     
-    # If no exact match, try chapter_id only
     if not filtered_chunks:
-        filtered_chunks = [
-            c for c in retrieved_chunks
-            if c.get("book_id") == book_id 
-            and c.get("chapter_id") == chapter_id
-        ]
-        logger.info(f"Filtered to {len(filtered_chunks)} chunks (by chapter_id only)")
+        logger.warning(f"No chunks of book {book_id} among indices: {idxs[:10]}... (showing first 10)")
     
-    # If still no match, try book_id only
-    if not filtered_chunks:
-        filtered_chunks = [
-            c for c in retrieved_chunks
-            if c.get("book_id") == book_id
-        ]
-        logger.info(f"Filtered to {len(filtered_chunks)} chunks (by book_id only)")
+    idxs = [c.get("embedding_index") for c in filtered_chunks]
+    dists = [score_by_index.get(i, 0.0) for i in idxs]
     
-    # Check relevance threshold (L2 distance for ada-002: <0.35 = good)
-    RELEVANCE_THRESHOLD = 0.35
-    if not filtered_chunks or (dists[0] > RELEVANCE_THRESHOLD):
-        logger.warning(f"No relevant content (best distance: {dists[0]:.4f})")
-        return {
+    # Check relevance threshold trên chunk tốt nhất sau khi lọc (cosine similarity, cao hơn = giống hơn)
+    best_score = dists[0] if dists else 0.0
+    if not filtered_chunks or best_score < RAG_RELEVANCE_THRESHOLD:
+        logger.warning(f"No relevant content (best similarity: {best_score:.4f})")
+        return {"result": ({
             "sections": [],
-            "note": f"Không tìm thấy nội dung phù hợp trong SGK (độ tương đồng thấp: {dists[0]:.2f}).",
+            "note": f"Không tìm thấy nội dung phù hợp trong SGK (độ tương đồng thấp: {best_score:.2f}).",
             "sources": []
-        }, dists[:len(filtered_chunks)], idxs[:len(filtered_chunks)]
+        }, dists, idxs)}
     
     # Build prompt + Call LLM
     lesson_info = {
@@ -408,46 +469,92 @@ def rag_query(grade: int, book_id: str, chapter_id: str, lesson_id: str, content
         "chapter": chapter.get("title", "") if chapter else "",
         "chapter_full": chapter.get("title", "") if chapter else ""
     }
-    prompt = _build_prompt(filtered_chunks, lesson_info, content)
-    outline = _call_llm(prompt)
+    prompt_chunks = _dedupe_chunks(filtered_chunks)
+    if len(prompt_chunks) < len(filtered_chunks):
+        logger.info(f"Deduplicated prompt chunks: {len(filtered_chunks)} -> {len(prompt_chunks)}")
+    # Tên sách/chương/bài cho cả prompt lẫn sources: 3 query MongoDB cho cả request
+    titles = _fetch_titles(prompt_chunks + filtered_chunks[:3])
+    return {
+        "prompt": _build_prompt(prompt_chunks, lesson_info, content, titles),
+        "titles": titles,
+        "chunks": filtered_chunks,
+        "dists": dists,
+        "idxs": idxs,
+        "qvec": qvec,
+        "cache_bucket": cache_bucket,
+    }
+
+_TIER_NAMES = ("book_id only", "chapter_id only", "chapter_id + lesson_id")
+
+def _select_best_tier(chunks: List[dict], chapter_id: str, lesson_id: str) -> Tuple[List[dict], str]:
+    """
+    Giữ các chunk khớp metadata nhất: cùng chương + bài > cùng chương > cùng sách.
+    1 lượt tính tier cho từng chunk rồi lọc tier cao nhất, giữ nguyên thứ tự similarity.
+    So sánh bằng như trước: chapter_id / lesson_id = None chỉ khớp chunk không có field đó
+    """
+    tiers = []
+    for c in chunks:
+        tier = 0
+        if c.get("chapter_id") == chapter_id:
+            tier = 2 if c.get("lesson_id") == lesson_id else 1
+        tiers.append(tier)
+    best = max(tiers, default=0)
+    return [c for c, t in zip(chunks, tiers) if t == best], _TIER_NAMES[best]
+
+def _finalize(outline: dict, ctx: dict) -> Tuple[dict, List[float], List[int]]:
+    """Gắn sources vào outline LLM trả về + lưu semantic cache"""
+    book_names, chapter_titles, lesson_titles = ctx["titles"]
+    filtered_chunks, dists, idxs = ctx["chunks"], ctx["dists"], ctx["idxs"]
     
     # Add source citations - lấy tên từ MongoDB collections thay vì từ chunk metadata
     outline["sources"] = []
     for i, chunk in enumerate(filtered_chunks[:3]):  # Top 3 sources
-        source_dist = dists[i] if i < len(dists) else 1.0
-        
-        # Lấy book_name từ BookRepository
-        chunk_book_id = chunk.get("book_id")
-        book_name = "N/A"
-        if chunk_book_id:
-            chunk_book = book_repo.get_book_by_id(chunk_book_id)
-            if chunk_book:
-                book_name = chunk_book.get("book_name", "N/A")
-        
-        # Lấy chapter title từ ChapterRepository
-        chunk_chapter_id = chunk.get("chapter_id")
-        chapter_title = "N/A"
-        if chunk_chapter_id:
-            chunk_chapter = chapter_repo.get_chapter_by_id(chunk_chapter_id)
-            if chunk_chapter:
-                chapter_title = chunk_chapter.get("title", "N/A")
-        
-        # Lấy lesson title từ LessonRepository
-        chunk_lesson_id = chunk.get("lesson_id")
-        lesson_title = "N/A"
-        if chunk_lesson_id:
-            chunk_lesson = lesson_repo.get_lesson_by_id(chunk_lesson_id)
-            if chunk_lesson:
-                lesson_title = chunk_lesson.get("title", "N/A")
-        
+        source_score = dists[i]
         outline["sources"].append({
-            "book": book_name,
-            "chapter": chapter_title,
-            "lesson": lesson_title,
+            "book": book_names.get(chunk.get("book_id"), "N/A"),
+            "chapter": chapter_titles.get(chunk.get("chapter_id"), "N/A"),
+            "lesson": lesson_titles.get(chunk.get("lesson_id"), "N/A"),
             "pages": [chunk.get("page", 0)],
-            "confidence": round(max(0, 1 - source_dist), 4)  # Convert L2 to 0-1 score
+            "confidence": round((source_score + 1) / 2, 4)  # Cosine [-1, 1] -> [0, 1]
         })
     
     logger.info(f"Generated outline with {len(outline.get('sections', []))} sections from {len(filtered_chunks)} chunks")
     
-    return outline, dists[:len(filtered_chunks)], idxs[:len(filtered_chunks)]
+    # Chỉ cache khi LLM trả outline hợp lệ (có sections)
+    if outline.get("sections"):
+        llm_cache.store(ctx["qvec"], ctx["cache_bucket"], {
+            "outline": outline,
+            "distances": dists,
+            "indices": idxs,
+        })
+    
+    return outline, dists, idxs
+
+def rag_query(grade: int, book_id: str, chapter_id: str, lesson_id: str, content: str, k: int = 8) -> Tuple[dict, List[float], List[int]]:
+    """
+    RAG Query với filtering theo book_id, chapter_id, lesson_id
+    """
+    ctx = _retrieve(grade, book_id, chapter_id, lesson_id, content, k)
+    if "result" in ctx:
+        return ctx["result"]
+    outline = _call_llm(*ctx["prompt"])
+    return _finalize(outline, ctx)
+
+def rag_query_stream(grade: int, book_id: str, chapter_id: str, lesson_id: str, content: str, k: int = 8) -> Iterator[Tuple[str, Any]]:
+    """
+    Như rag_query nhưng stream output của LLM:
+    yield ("delta", text) cho từng đoạn JSON LLM sinh ra, cuối cùng ("result", (outline, dists, idxs))
+    """
+    ctx = _retrieve(grade, book_id, chapter_id, lesson_id, content, k)
+    if "result" in ctx:
+        yield "result", ctx["result"]
+        return
+    llm = _call_llm_stream(*ctx["prompt"])
+    while True:
+        try:
+            delta = next(llm)
+        except StopIteration as done:
+            outline = done.value
+            break
+        yield "delta", delta
+    yield "result", _finalize(outline, ctx)
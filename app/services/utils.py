@@ -1,6 +1,43 @@
 import os
-from app.core.config import DATA_DIR, CACHE_DIR
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List
+import faiss
+from app.core.config import DATA_DIR, CACHE_DIR, FAISS_NUM_THREADS
+from app.core.logger import get_logger
+
+logger = get_logger(__name__)
+
+_DIRS_ENSURED = False
 
 def ensure_data_dirs():
+    # makedirs(exist_ok=True) vẫn stat từng thành phần của path -> chỉ làm lần đầu trong process
+    global _DIRS_ENSURED
+    if _DIRS_ENSURED:
+        return
     os.makedirs(DATA_DIR, exist_ok=True)
     os.makedirs(CACHE_DIR, exist_ok=True)
+    _DIRS_ENSURED = True
+
+def configure_faiss():
+    """Set FAISS OpenMP threads and warn if the installed build lacks AVX2 kernels."""
+    threads = FAISS_NUM_THREADS or os.cpu_count() or 1
+    faiss.omp_set_num_threads(threads)
+    logger.info(f"FAISS using {threads} OpenMP threads")
+
+    # supported_instruction_sets() only exists on faiss >= 1.7.3
+    get_instruction_sets = getattr(faiss, "supported_instruction_sets", None)
+    if get_instruction_sets is not None:
+        instruction_sets = get_instruction_sets()
+        if "AVX2" not in instruction_sets and "AVX512" not in instruction_sets:
+            logger.warning(
+                "FAISS build/CPU has no AVX2 support - vector search falls back to slower scalar kernels"
+            )
+
+# Pool dùng chung cho các lookup I/O độc lập trong 1 request (pymongo là sync: mỗi lookup chiếm 1 thread
+# trong lúc chờ network). Không submit lồng từ chính thread của pool này
+_io_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="io")
+
+def run_parallel(*calls: Callable[[], Any]) -> List[Any]:
+    """Chạy đồng thời các hàm I/O không phụ thuộc nhau, trả kết quả theo đúng thứ tự truyền vào"""
+    futures = [_io_pool.submit(call) for call in calls]
+    return [f.result() for f in futures]
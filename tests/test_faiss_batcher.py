@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+pytest.importorskip("dotenv")
+
+from app.services.faiss_batcher import FaissBatcher
+
+
+def _flat_index(dim: int, n: int, seed: int):
+    rng = np.random.default_rng(seed)
+    index = faiss.IndexFlatL2(dim)
+    index.add(rng.random((n, dim), dtype="float32"))
+    return index
+
+
+class _CountingBatcher(FaissBatcher):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def _search(self, index, xq, k):
+        self.calls.append((index, xq.shape[0], k))
+        return super()._search(index, xq, k)
+
+
+def _assert_same_as_direct(index, qvec, k, result):
+    distances, indices = result
+    expected_d, expected_i = index.search(qvec, k)
+    assert distances.shape == indices.shape == (1, k)
+    np.testing.assert_array_equal(indices, expected_i)
+    # Batch lớn dùng BLAS nên khoảng cách có thể lệch ở bit cuối
+    np.testing.assert_allclose(distances, expected_d, rtol=1e-5, atol=1e-5)
+
+
+def test_concurrent_searches_with_mixed_k_and_indexes_match_direct_search():
+    # Index flat: top-k của lần search gộp (k lớn nhất) trùng với search riêng từng k
+    indexes = [_flat_index(16, 500, seed=1), _flat_index(16, 300, seed=2)]
+    rng = np.random.default_rng(3)
+    requests = [
+        (indexes[i % 2], rng.random((1, 16), dtype="float32"), (1, 3, 5, 10)[i % 4])
+        for i in range(24)
+    ]
+    batcher = _CountingBatcher(window_ms=50, max_batch=32)
+    barrier = threading.Barrier(len(requests))
+    results = [None] * len(requests)
+
+    def worker(slot, index, qvec, k):
+        barrier.wait()
+        results[slot] = batcher.search(index, qvec, k)
+
+    threads = [threading.Thread(target=worker, args=(slot, *req)) for slot, req in enumerate(requests)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    for (index, qvec, k), result in zip(requests, results):
+        _assert_same_as_direct(index, qvec, k, result)
+    # Query đã được gộp, và mỗi lần search chỉ chạy trên một index
+    assert len(batcher.calls) < len(requests)
+    assert sum(rows for _, rows, _ in batcher.calls) == len(requests)
+    for index, _, k in batcher.calls:
+        assert index in indexes and k <= 10
+
+
+def test_zero_window_searches_inline():
+    index = _flat_index(8, 50, seed=4)
+    qvec = np.random.default_rng(5).random((1, 8), dtype="float32")
+    batcher = _CountingBatcher(window_ms=0, max_batch=32)
+
+    _assert_same_as_direct(index, qvec, 4, batcher.search(index, qvec, 4))
+    # Không qua hàng đợi: không khởi động worker thread, search 1 query đúng k yêu cầu
+    assert batcher._worker is None
+    assert [(rows, k) for _, rows, k in batcher.calls] == [(1, 4)]
+
+
+def test_search_error_is_raised_to_caller():
+    index = _flat_index(8, 50, seed=6)
+    batcher = FaissBatcher(window_ms=5, max_batch=32)
+
+    with pytest.raises(Exception):
+        batcher.search(index, np.zeros((1, 4), dtype="float32"), 3)
+    # Worker vẫn chạy tiếp cho các request sau
+    qvec = np.zeros((1, 8), dtype="float32")
+    _assert_same_as_direct(index, qvec, 3, batcher.search(index, qvec, 3))
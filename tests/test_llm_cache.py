@@ -0,0 +1,96 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("orjson")
+pytest.importorskip("dotenv")
+
+from app.services.llm_cache import SemanticCache, cache_bucket
+
+
+def _cache(tmp_path):
+    return SemanticCache(
+        index_path=str(tmp_path / "llm_cache.faiss"),
+        data_path=str(tmp_path / "llm_cache.json"),
+        threshold=0.95,
+        bucket_size=10,
+    )
+
+
+def test_short_notes_in_same_lesson_do_not_collide(tmp_path):
+    cache = _cache(tmp_path)
+    # Cùng vector (embedding bị tên chương/bài chi phối) nhưng ghi chú khác nhau
+    vec = np.ones(8, dtype="float32")
+    bucket_a = cache_bucket("book", "chapter", "lesson", 5, "Ví dụ về tam giác vuông")
+    bucket_b = cache_bucket("book", "chapter", "lesson", 5, "Ví dụ về hình tròn")
+    assert bucket_a != bucket_b
+
+    cache.store(vec, bucket_a, {"outline": "a", "distances": [0.9], "indices": [1]})
+
+    assert cache.lookup(vec, bucket_b) is None
+    assert cache.lookup(vec, bucket_a)["outline"] == "a"
+
+
+def test_same_note_ignores_case_and_whitespace():
+    assert cache_bucket("book", "chapter", "lesson", 5, "Ví dụ  về tam giác ") == \
+        cache_bucket("book", "chapter", "lesson", 5, "ví dụ về tam giác")
+
+
+def test_k_is_part_of_bucket(tmp_path):
+    cache = _cache(tmp_path)
+    vec = np.ones(8, dtype="float32")
+    cache.store(vec, cache_bucket("book", "chapter", "lesson", 5, ""), {"outline": "k5"})
+
+    assert cache.lookup(vec, cache_bucket("book", "chapter", "lesson", 8, "")) is None
+
+
+def _unit(i, dim=8):
+    vec = np.zeros(dim, dtype="float32")
+    vec[i] = 1.0
+    return vec
+
+
+def test_workers_merge_entries_on_save(tmp_path):
+    # 2 instance trên cùng file = 2 uvicorn worker
+    worker_a, worker_b = _cache(tmp_path), _cache(tmp_path)
+    bucket = cache_bucket("book", "chapter", "lesson", 5, "")
+    worker_a.store(_unit(0), bucket, {"outline": "a"})
+    worker_b.store(_unit(1), bucket, {"outline": "b"})
+    worker_a.save()
+    worker_b.save()
+
+    fresh = _cache(tmp_path)
+    assert fresh.lookup(_unit(0), bucket)["outline"] == "a"
+    assert fresh.lookup(_unit(1), bucket)["outline"] == "b"
+
+
+def test_invalidate_book_reaches_other_workers(tmp_path):
+    worker_a, worker_b = _cache(tmp_path), _cache(tmp_path)
+    bucket = cache_bucket("book", "chapter", "lesson", 5, "")
+    other = cache_bucket("other-book", "chapter", "lesson", 5, "")
+    worker_a.store(_unit(0), bucket, {"outline": "stale"})
+    worker_a.store(_unit(0), other, {"outline": "kept"})
+    worker_a.save()
+    assert worker_b.lookup(_unit(0), bucket)["outline"] == "stale"
+
+    worker_a.invalidate_book("book")
+
+    assert worker_b.lookup(_unit(0), bucket) is None
+    assert worker_b.lookup(_unit(0), other)["outline"] == "kept"
+    # Worker chưa từng gọi invalidate_book lưu lại cũng không làm sống lại entry cũ
+    worker_b.store(_unit(1), other, {"outline": "new"})
+    worker_b.save()
+    assert _cache(tmp_path).lookup(_unit(0), bucket) is None
+
+
+def test_invalidate_all_reaches_other_workers(tmp_path):
+    worker_a, worker_b = _cache(tmp_path), _cache(tmp_path)
+    bucket = cache_bucket("book", "chapter", "lesson", 5, "")
+    worker_b.store(_unit(0), bucket, {"outline": "old indices"})
+    worker_b.save()
+
+    worker_a.invalidate_all()
+
+    assert worker_b.lookup(_unit(0), bucket) is None
+    worker_b.save()
+    assert _cache(tmp_path).lookup(_unit(0), bucket) is None
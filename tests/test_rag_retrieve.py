@@ -0,0 +1,107 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+pytest.importorskip("openai")
+pytest.importorskip("pymongo")
+pytest.importorskip("dotenv")
+
+from app.services import rag_engine
+from app.services.faiss_batcher import FaissBatcher
+
+
+def _chunk(i, chapter_id="c1", lesson_id="l1", book_id="b1"):
+    chunk = {"embedding_index": i, "book_id": book_id, "content": f"chunk {i}"}
+    # None = chunk không có field (sách ingest không tách được chương/bài)
+    if chapter_id is not None:
+        chunk["chapter_id"] = chapter_id
+    if lesson_id is not None:
+        chunk["lesson_id"] = lesson_id
+    return chunk
+
+
+def _ids(chunks):
+    return [c["embedding_index"] for c in chunks]
+
+
+def test_tier_chapter_and_lesson_keeps_similarity_order():
+    chunks = [_chunk(0, "c2", "l9"), _chunk(1, "c1", "l2"), _chunk(2, "c1", "l1"), _chunk(3, "c1", "l1")]
+    selected, tier = rag_engine._select_best_tier(chunks, "c1", "l1")
+    assert (_ids(selected), tier) == ([2, 3], "chapter_id + lesson_id")
+
+
+def test_tier_falls_back_to_chapter_then_book():
+    chunks = [_chunk(0, "c2", "l9"), _chunk(1, "c1", "l2"), _chunk(2, "c1", "l3")]
+    assert rag_engine._select_best_tier(chunks, "c1", "l1") == ([chunks[1], chunks[2]], "chapter_id only")
+    assert rag_engine._select_best_tier(chunks, "c9", "l1") == (chunks, "book_id only")
+    assert rag_engine._select_best_tier([], "c1", "l1") == ([], "book_id only")
+
+
+def test_tier_none_ids_only_match_chunks_without_the_field():
+    chunks = [_chunk(0, "c1", "l1"), _chunk(1, None, None), _chunk(2, "c1", None), _chunk(3, None, "l1")]
+    assert _ids(rag_engine._select_best_tier(chunks, None, None)[0]) == [1]
+    assert rag_engine._select_best_tier(chunks, None, "l1") == ([chunks[3]], "chapter_id + lesson_id")
+    assert rag_engine._select_best_tier(chunks, "c1", None) == ([chunks[2]], "chapter_id + lesson_id")
+    # Chỉ có chunk thiếu chương: chapter_id None rơi về tier chương khi bài không khớp
+    assert rag_engine._select_best_tier(chunks[1:2], None, "l1") == ([chunks[1]], "chapter_id only")
+
+
+class _NoCache:
+    def lookup(self, qvec, bucket):
+        return None
+
+
+class _FakeChunkRepository:
+    chunks = []
+
+    def get_chunks_by_indices_filtered(self, indices, book_id):
+        by_index = {c["embedding_index"]: c for c in self.chunks if c["book_id"] == book_id}
+        return [by_index[i] for i in indices if i in by_index]
+
+
+@pytest.fixture
+def retrieve(monkeypatch):
+    """_retrieve với index flat IP: chunk i có cosine similarity scores[i] với query."""
+    def run(chunks, scores):
+        dim = 4
+        index = faiss.IndexFlatIP(dim)
+        index.add(np.array([[s, math.sqrt(1 - s * s), 0, 0] for s in scores], dtype="float32"))
+        _FakeChunkRepository.chunks = chunks
+        monkeypatch.setattr(rag_engine, "cached_get_lesson", lambda _id: {"title": "Bài 1. Mệnh đề"})
+        monkeypatch.setattr(rag_engine, "cached_get_chapter", lambda _id: {"title": "Chương I. Mệnh đề"})
+        monkeypatch.setattr(rag_engine, "cached_get_book", lambda _id: {"title": "Toán 10"})
+        monkeypatch.setattr(rag_engine, "cached_embed_query", lambda q: np.array([1, 0, 0, 0], dtype="float32"))
+        monkeypatch.setattr(rag_engine, "llm_cache", _NoCache())
+        monkeypatch.setattr(rag_engine, "_load_index", lambda: (index, len(chunks)))
+        monkeypatch.setattr(rag_engine, "_faiss_batcher", FaissBatcher(window_ms=0, max_batch=1))
+        monkeypatch.setattr(rag_engine, "ChunkRepository", _FakeChunkRepository)
+        monkeypatch.setattr(rag_engine, "_fetch_titles", lambda chunks: ({}, {}, {}))
+        monkeypatch.setattr(rag_engine, "_build_prompt", lambda *args: "prompt")
+        monkeypatch.setattr(rag_engine, "RAG_RELEVANCE_THRESHOLD", 0.75)
+        return rag_engine._retrieve(10, "b1", "c1", "l1", "", k=5)
+    return run
+
+
+def test_threshold_uses_best_chunk_of_selected_tier(retrieve):
+    # Chunk giống nhất (0.95) thuộc bài khác -> bị lọc; chunk tốt nhất còn lại 0.8 vẫn qua ngưỡng
+    chunks = [_chunk(0, "c1", "l2"), _chunk(1, "c1", "l1"), _chunk(2, "c1", "l1")]
+    ctx = retrieve(chunks, [0.95, 0.8, 0.78])
+    assert "result" not in ctx
+    assert _ids(ctx["chunks"]) == ctx["idxs"] == [1, 2]
+    assert ctx["dists"] == pytest.approx([0.8, 0.78], abs=1e-5)
+
+
+def test_threshold_rejects_when_only_filtered_out_chunks_are_relevant(retrieve):
+    # Chunk sách khác (0.99) và bài khác (0.9) đều vượt ngưỡng nhưng bị lọc; chunk cùng bài chỉ 0.6
+    chunks = [_chunk(0, book_id="b2"), _chunk(1, "c1", "l2"), _chunk(2, "c1", "l1")]
+    outline, dists, idxs = retrieve(chunks, [0.99, 0.9, 0.6])["result"]
+    assert outline["sections"] == [] and "0.60" in outline["note"]
+    assert idxs == [2]
+    assert dists == pytest.approx([0.6], abs=1e-5)
+
+
+def test_threshold_on_empty_selection(retrieve):
+    outline, dists, idxs = retrieve([_chunk(0, book_id="b2")], [0.99])["result"]
+    assert outline["sections"] == [] and (dists, idxs) == ([], [])